@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the conversion of suds objects to records.
+
+Parses synthetic getCampaigns, getAffiliateSites and getReportCampaign responses of
+fake_server.py with suds (offline, from the local WSDL), converts the suds objects
+with the former converter (sobject_to_dict and humps.decamelize) and with
+sobject_to_record, and reports the records per second of both.
+
+Usage: bench_convert.py [--campaigns 200] [--affiliate-sites 5000] [--reports 5000] [--output result.json]
+"""
+import sys
+import json
+import time
+import datetime
+import argparse
+import tempfile
+
+import humps
+
+from tap_tradetracker.client import get_wsdl_client, sobject_to_record
+
+from fake_server import ENVELOPE, WSDL_PATH, affiliate_site, campaign, report_campaign
+
+
+def former_sobject_to_dict(obj, key_to_lower=False, json_serialize=False):
+    """The sobject_to_dict of the client before sobject_to_record"""
+    if not hasattr(obj, '__keylist__'):
+        if json_serialize and isinstance(obj, (datetime.datetime, datetime.time, datetime.date)):
+            return obj.isoformat()
+        else:
+            return obj
+    data = {}
+    fields = obj.__keylist__
+    for field in fields:
+        val = getattr(obj, field)
+        if key_to_lower:
+            field = field.lower()
+        if isinstance(val, list):
+            data[field] = []
+            for item in val:
+                data[field].append(former_sobject_to_dict(item, json_serialize=json_serialize))
+        elif isinstance(val, (datetime.datetime, datetime.time, datetime.date)):
+            data[field] = val.isoformat()
+        else:
+            data[field] = former_sobject_to_dict(val, json_serialize=json_serialize)
+    return data
+
+
+def convert_former(obj):
+    return humps.decamelize(former_sobject_to_dict(obj))
+
+
+def get_sobjects(client, args):
+    """Returns the suds objects of the synthetic responses, by stream"""
+    campaigns = ''.join(campaign(i) for i in range(1, args.campaigns + 1))
+    reply = ENVELOPE.format(f'<ns1:getCampaignsResponse><campaigns xsi:type="ns1:CampaignArray"'
+                            f' SOAP-ENC:arrayType="ns1:Campaign[{args.campaigns}]">{campaigns}'
+                            '</campaigns></ns1:getCampaignsResponse>')
+    sobjects = {'campaigns': client.service.getCampaigns(__inject={'reply': reply.encode('utf-8')})}
+
+    affiliate_sites = ''.join(affiliate_site(i) for i in range(1, args.affiliate_sites + 1))
+    reply = ENVELOPE.format(f'<ns1:getAffiliateSitesResponse><affiliateSites xsi:type="ns1:AffiliateSiteArray"'
+                            f' SOAP-ENC:arrayType="ns1:AffiliateSite[{args.affiliate_sites}]">{affiliate_sites}'
+                            '</affiliateSites></ns1:getAffiliateSitesResponse>')
+    sobjects['affiliate_sites'] = client.service.getAffiliateSites(
+        1, client.factory.create('AffiliateSiteFilter'), __inject={'reply': reply.encode('utf-8')})
+
+    # a report is one object per response
+    reply = ENVELOPE.format(report_campaign()).encode('utf-8')
+    report = client.service.getReportCampaign(campaignID=1, options=client.factory.create('ReportCampaignFilter'),
+                                              __inject={'reply': reply})
+    sobjects['campaign_report'] = [report] * args.reports
+    return sobjects
+
+
+def measure(convert, sobjects):
+    """Returns the records per second and the records"""
+    start = time.perf_counter()
+    records = [convert(obj) for obj in sobjects]
+    return len(sobjects) / (time.perf_counter() - start), records
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = get_wsdl_client(WSDL_PATH, cache_dir=cache_dir)
+        sobjects = get_sobjects(client, args)
+
+    result = {'parameters': {key: value for key, value in vars(args).items() if key != 'output'}, 'streams': {}}
+    for stream_name, stream_sobjects in sobjects.items():
+        former, former_records = measure(convert_former, stream_sobjects)
+        single_pass, records = measure(sobject_to_record, stream_sobjects)
+        if former_records != records:
+            raise Exception(f'{stream_name}: sobject_to_record converts the objects differently')
+        result['streams'][stream_name] = {
+            'records': len(stream_sobjects),
+            'former_records_per_second': round(former, 1),
+            'single_pass_records_per_second': round(single_pass, 1),
+            'speedup': round(single_pass / former, 2),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--campaigns', type=int, default=200)
+    parser.add_argument('--affiliate-sites', type=int, default=5000)
+    parser.add_argument('--reports', type=int, default=5000, help='number of conversions of a report object')
+    parser.add_argument('--output', help='write the result to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the record pipeline (transformation of records for Singer).
+
+Transforms synthetic affiliate_sites and campaign_report records (snake_case dicts
+as returned by the client) with the record pipeline of the former process_records()
+(catalog lookup, schema, metadata and a new Transformer per record) and with the
+compiled StreamPipeline, and reports the records per second of both.
+
+Usage: bench_pipeline.py [--records 20000] [--output result.json]
+"""
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+
+from singer import metadata, Transformer
+
+from tap_tradetracker.discover import discover
+from tap_tradetracker.sync import StreamPipeline
+
+
+def affiliate_site(affiliate_site_id):
+    return {
+        'ID': affiliate_site_id,
+        'name': f'Site {affiliate_site_id}',
+        'URL': f'https://site{affiliate_site_id}.example',
+        'info': {
+            'type': {'ID': 1, 'name': 'Website'},
+            'category': {'ID': 2, 'name': 'Blog'},
+            'description': None,
+            'assignment_status': 'accepted',
+            'campaign_segment': {'ID': 4, 'name': 'Default'},
+            'assignment_date': '2020-03-04T10:11:12+01:00',
+            'modification_date': None,
+            'trade_rules_enabled': True,
+        },
+        'campaign_id': 1,
+    }
+
+
+def campaign_report(day):
+    record = {field: 7 for field in ('overall_impression_count', 'unique_impression_count', 'overall_click_count',
+                                     'unique_click_count', 'lead_count', 'sale_count')}
+    record.update({field: 1.2345678912345 for field in ('impression_commission', 'click_commission',
+                                                         'lead_commission', 'sale_commission', 'fixed_commission',
+                                                         'CTR', 'CLR', 'CSR', 'CPO', 'ecpm', 'ecpc',
+                                                         'order_amount', 'total_commission')})
+    record.update({'campaign_id': 1, 'date': f'2026-01-{day % 28 + 1:02d}', 'end_date': f'2026-01-{day % 28 + 1:02d}'})
+    return record
+
+
+RECORDS = {
+    'affiliate_sites': affiliate_site,
+    'campaign_report': campaign_report,
+}
+
+
+def former_pre_hook(data, typ, schema):
+    """The transform_pre_hook of process_records() before the compiled pipeline"""
+    if typ == 'number':
+        if schema.get('multipleOf'):
+            max_decimal_palces = len(str(schema.get('multipleOf')))-2
+            if max_decimal_palces < 0:
+                max_decimal_palces = 0
+            if isinstance(data, float):
+                return round(data, max_decimal_palces)
+    if typ == 'string' and schema.get('format') == 'date-time':
+        if data: # ignore 'None'
+            dt = datetime.strptime(data, '%Y-%m-%dT%H:%M:%S%z').astimezone(timezone.utc)
+            return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    return data
+
+
+def transform_former(catalog, stream_name, records):
+    """The record pipeline of process_records() before the compiled pipeline"""
+    for record in records:
+        stream = catalog.get_stream(stream_name)
+        schema = stream.schema.to_dict()
+        stream_metadata = metadata.to_map(stream.metadata)
+        with Transformer(pre_hook=former_pre_hook) as transformer:
+            yield transformer.transform(record, schema, stream_metadata)
+
+
+def transform_compiled(catalog, stream_name, records):
+    pipeline = StreamPipeline(catalog, stream_name)
+    for record in records:
+        yield pipeline.transform(record)
+
+
+def measure(transform, catalog, stream_name, records):
+    """Returns the records per second and the transformed records"""
+    start = time.perf_counter()
+    transformed = list(transform(catalog, stream_name, records))
+    return len(records) / (time.perf_counter() - start), transformed
+
+
+def run(args):
+    catalog = discover()
+    result = {'parameters': {'records': args.records}, 'streams': {}}
+    for stream_name, get_record in RECORDS.items():
+        records = [get_record(i) for i in range(args.records)]
+        former, former_records = measure(transform_former, catalog, stream_name, records)
+        compiled, compiled_records = measure(transform_compiled, catalog, stream_name, records)
+        if former_records != compiled_records:
+            raise Exception(f'{stream_name}: the compiled pipeline transforms the records differently')
+        result['streams'][stream_name] = {
+            'former_records_per_second': round(former, 1),
+            'compiled_records_per_second': round(compiled, 1),
+            'speedup': round(compiled / former, 2),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=20000, help='records per stream')
+    parser.add_argument('--output', help='write the result to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
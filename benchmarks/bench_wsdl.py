@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the client startup (loading of the WSDL) for several passphrases.
+
+Creates the suds clients of N passphrases (countries) from the local stand-in WSDL
+of fake_server.py (or another stored WSDL, --wsdl), and reports the seconds of:
+- cold: a client per passphrase, each parsing the WSDL (without a cache)
+- disk_cache: a client per passphrase with the default suds cache of a former run,
+  which holds the XML documents of the WSDL (the clients before get_wsdl_client)
+- shared_cold: get_wsdl_client, which parses the WSDL once per process and clones
+  the client for every passphrase (empty on-disk cache, the first run)
+- shared_disk_cache: get_wsdl_client with the on-disk cache (of the parsed WSDL) of
+  a former run
+Each mode is repeated and the median is reported.
+
+Usage: bench_wsdl.py [--passphrases 10] [--repeat 5] [--wsdl merchant.wsdl] [--output result.json]
+"""
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+from suds.cache import NoCache, ObjectCache
+from suds.client import Client
+
+from tap_tradetracker import client as tradetracker_client
+from tap_tradetracker.client import SoapFixer, get_wsdl_client, get_wsdl_url
+
+from fake_server import WSDL_PATH
+
+
+def create_cold(wsdl, passphrases, cache_dir):
+    return [Client(get_wsdl_url(wsdl), cache=NoCache(), plugins=[SoapFixer()]) for _ in range(passphrases)]
+
+
+def create_disk_cache(wsdl, passphrases, cache_dir):
+    return [Client(get_wsdl_url(wsdl), cache=ObjectCache(location=cache_dir, days=0), plugins=[SoapFixer()])
+            for _ in range(passphrases)]
+
+
+def create_shared(wsdl, passphrases, cache_dir):
+    # a new process: the WSDL is not loaded yet
+    tradetracker_client._WSDL_CLIENTS.clear()  # pylint: disable=protected-access
+    return [get_wsdl_client(wsdl, cache_dir=cache_dir, cache_days=0) for _ in range(passphrases)]
+
+
+def measure(create, wsdl, passphrases, repeat, warm_cache):
+    """Returns the median seconds of the creation of the clients of all passphrases"""
+    durations = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            if warm_cache:
+                # the on-disk cache of a former run
+                create(wsdl, 1, cache_dir)
+            start = time.perf_counter()
+            clients = create(wsdl, passphrases, cache_dir)
+            durations.append(time.perf_counter() - start)
+        if len(clients) != passphrases or clients[-1].factory.create('ReportCampaignFilter') is None:
+            raise Exception(f'{create.__name__}: the clients are not usable')
+    return statistics.median(durations)
+
+
+def run(args):
+    modes = {
+        'cold': (create_cold, False),
+        'disk_cache': (create_disk_cache, True),
+        'shared_cold': (create_shared, False),
+        'shared_disk_cache': (create_shared, True),
+    }
+    result = {'parameters': {key: value for key, value in vars(args).items() if key != 'output'}, 'modes': {}}
+    for mode, (create, warm_cache) in modes.items():
+        seconds = measure(create, args.wsdl, args.passphrases, args.repeat, warm_cache)
+        result['modes'][mode] = {
+            'seconds': round(seconds, 4),
+            'seconds_per_passphrase': round(seconds / args.passphrases, 4),
+        }
+    cold = result['modes']['cold']['seconds']
+    for mode in result['modes'].values():
+        mode['speedup'] = round(cold / mode['seconds'], 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--passphrases', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--wsdl', default=WSDL_PATH, help='path of a stored WSDL (default: the stand-in WSDL)')
+    parser.add_argument('--output', help='write the result to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
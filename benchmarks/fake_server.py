@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Local stand-in of the TradeTracker merchant SOAP service for offline benchmarks.
+
+Serves the WSDL (GET) and synthetic responses (POST) of authenticate, getCampaigns,
+getAffiliateSites, getReportCampaign and getConversionTransactions (paged by
+limit/offset) with a configurable number of campaigns, affiliate sites and
+transactions per campaign (spread over the last 60 days), response latency and rate
+of transient faults. The last campaigns
+can be ended (stopped 60 days ago), the ones before them without data (empty reports). GET /stats
+returns the number of requests per SOAP action as JSON.
+
+Usage: fake_server.py [--port 0] [--campaigns 10] [--affiliate-sites 50] [--latency 0] [--fault-rate 0]
+                      [--shared-affiliate-sites] [--ended-campaigns 0] [--empty-campaigns 0] [--transactions 0]
+The listening port is printed as the first line on stdout.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WSDL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merchant.wsdl')
+WSDL_LOCATION = 'http://localhost/soap/merchant'
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"'
+    ' xmlns:ns1="http://ws.tradetracker.com/soap/merchant"'
+    ' xmlns:xsd="http://www.w3.org/2001/XMLSchema"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    ' xmlns:SOAP-ENC="http://schemas.xmlsoap.org/soap/encoding/"'
+    ' SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+    '<SOAP-ENV:Body>{}</SOAP-ENV:Body></SOAP-ENV:Envelope>')
+
+SESSION_FAULT = ('<SOAP-ENV:Fault><faultcode>SOAP-ENV:Client</faultcode>'
+                 '<faultstring>Not authenticated</faultstring></SOAP-ENV:Fault>')
+
+REPORT_FIELDS = ['overallImpressionCount', 'uniqueImpressionCount', 'impressionCommission',
+                 'overallClickCount', 'uniqueClickCount', 'clickCommission', 'leadCount',
+                 'leadCommission', 'saleCount', 'saleCommission', 'fixedCommission', 'CTR', 'CLR',
+                 'CSR', 'CPO', 'eCPM', 'eCPC', 'orderAmount', 'totalCommission']
+
+
+def id_name(tag, id_, name):
+    return (f'<{tag} xsi:type="ns1:IDName"><ID xsi:type="xsd:int">{id_}</ID>'
+            f'<name xsi:type="xsd:string">{name}</name></{tag}>')
+
+
+def campaign(campaign_id, ended=False):
+    stop_date = (f'<stopDate xsi:type="xsd:date">{date.today() - timedelta(days=60)}</stopDate>' if ended else
+                 '<stopDate xsi:nil="true"/>')
+    return (f'<item xsi:type="ns1:Campaign"><ID xsi:type="xsd:int">{campaign_id}</ID>'
+            f'<name xsi:type="xsd:string">Campaign {campaign_id}</name>'
+            f'<URL xsi:type="xsd:string">https://shop{campaign_id}.example</URL>'
+            f'<info xsi:type="ns1:CampaignInfo">{id_name("category", 3, "Shop")}'
+            '<campaignDescription xsi:type="xsd:string">Description</campaignDescription>'
+            '<shopDescription xsi:nil="true"/><targetGroup xsi:nil="true"/><characteristics xsi:nil="true"/>'
+            f'<startDate xsi:type="xsd:date">2019-01-01</startDate>{stop_date}'
+            '<timeZone xsi:type="xsd:string">Europe/Amsterdam</timeZone>'
+            '<clickToConversion xsi:type="xsd:string">30 days</clickToConversion>'
+            '<policySearchEngineMarketingStatus xsi:type="xsd:string">allowed</policySearchEngineMarketingStatus>'
+            '<policyEmailMarketingStatus xsi:type="xsd:string">allowed</policyEmailMarketingStatus>'
+            '<policyCashbackStatus xsi:type="xsd:string">allowed</policyCashbackStatus>'
+            '<policyDiscountCodeStatus xsi:type="xsd:string">allowed</policyDiscountCodeStatus>'
+            '</info></item>')
+
+
+def affiliate_site(affiliate_site_id):
+    return (f'<item xsi:type="ns1:AffiliateSite"><ID xsi:type="xsd:int">{affiliate_site_id}</ID>'
+            f'<name xsi:type="xsd:string">Site {affiliate_site_id}</name>'
+            f'<URL xsi:type="xsd:string">https://site{affiliate_site_id}.example</URL>'
+            f'<info xsi:type="ns1:AffiliateSiteInfo">{id_name("type", 1, "Website")}'
+            f'{id_name("category", 2, "Blog")}<description xsi:nil="true"/>'
+            '<assignmentStatus xsi:type="xsd:string">accepted</assignmentStatus>'
+            f'{id_name("campaignSegment", 4, "Default")}'
+            '<assignmentDate xsi:type="xsd:dateTime">2020-03-04T10:11:12+01:00</assignmentDate>'
+            '<modificationDate xsi:nil="true"/><tradeRulesEnabled xsi:type="xsd:boolean">true</tradeRulesEnabled>'
+            '</info></item>')
+
+
+def report_campaign(empty=False):
+    fields = ''.join(
+        f'<{field} xsi:type="xsd:int">{0 if empty else 7}</{field}>' if field.endswith('Count') else
+        f'<{field} xsi:type="xsd:float">{0 if empty else 1.2345678912345}</{field}>'
+        for field in REPORT_FIELDS)
+    return (f'<ns1:getReportCampaignResponse><reportCampaign xsi:type="ns1:ReportCampaign">{fields}'
+            '</reportCampaign></ns1:getReportCampaignResponse>')
+
+
+def get_transaction_dates(campaign_id, transactions):
+    """Returns the registration dates of the transactions of a campaign (ascending), spread over 60 days"""
+    end = datetime.combine(date.today(), dt_time(), tzinfo=timezone.utc)
+    step = timedelta(days=60) / max(transactions, 1)
+    return [(campaign_id * 1000000 + i, end - (transactions - i) * step) for i in range(transactions)]
+
+
+def conversion_transaction(campaign_id, transaction_id, registration_date):
+    return (f'<item xsi:type="ns1:ConversionTransaction"><ID xsi:type="xsd:int">{transaction_id}</ID>'
+            f'{id_name("campaign", campaign_id, f"Campaign {campaign_id}")}<campaignProduct xsi:nil="true"/>'
+            f'{id_name("affiliateSite", campaign_id * 100000, f"Site {campaign_id * 100000}")}'
+            '<transactionType xsi:type="xsd:string">sale</transactionType>'
+            '<transactionStatus xsi:type="xsd:string">pending</transactionStatus>'
+            '<numTouchPointsTotal xsi:type="xsd:int">1</numTouchPointsTotal>'
+            '<numTouchPointsAffiliate xsi:type="xsd:int">1</numTouchPointsAffiliate>'
+            '<characteristic xsi:nil="true"/><description xsi:nil="true"/>'
+            f'<referenceID xsi:type="xsd:string">order-{transaction_id}</referenceID>'
+            '<originatingClickDate xsi:nil="true"/>'
+            f'<registrationDate xsi:type="xsd:dateTime">{registration_date.isoformat()}</registrationDate>'
+            '<assessmentDate xsi:nil="true"/><rejectionReason xsi:nil="true"/>'
+            '<paidOut xsi:type="xsd:boolean">false</paidOut><currency xsi:type="xsd:string">EUR</currency>'
+            '<commission xsi:type="xsd:float">2.5</commission><orderAmount xsi:type="xsd:float">49.95</orderAmount>'
+            '<IP xsi:nil="true"/></item>')
+
+
+def get_option(request, name, parse=str):
+    match = re.search(rf'<{name}[^>]*>([^<]+)<', request)
+    return parse(match.group(1)) if match else None
+
+
+class FakeTradeTrackerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately; without TCP_NODELAY every
+        # keep-alive response would wait for the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_body(self, status, body, content_type='text/xml; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path == '/stats':
+            with self.server.lock:
+                body = json.dumps(self.server.request_counts).encode('utf-8')
+            self.send_body(200, body, 'application/json')
+        else:
+            self.send_body(200, self.server.wsdl)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        request = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        action = self.headers.get('SOAPAction', '').strip('"').rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.request_counts[action] = self.server.request_counts.get(action, 0) + 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        # transient faults: half HTTP 503, half an expired session
+        if action != 'authenticate' and random.random() < self.server.fault_rate:
+            if random.random() < 0.5:
+                self.send_body(503, b'')
+            else:
+                self.send_body(500, ENVELOPE.format(SESSION_FAULT).encode('utf-8'))
+            return
+
+        if action == 'authenticate':
+            payload = '<ns1:authenticateResponse/>'
+        elif action == 'getCampaigns':
+            first_ended = self.server.campaigns - self.server.ended_campaigns + 1
+            items = ''.join(campaign(i, ended=i >= first_ended) for i in range(1, self.server.campaigns + 1))
+            payload = (f'<ns1:getCampaignsResponse><campaigns xsi:type="ns1:CampaignArray"'
+                       f' SOAP-ENC:arrayType="ns1:Campaign[{self.server.campaigns}]">{items}'
+                       '</campaigns></ns1:getCampaignsResponse>')
+        elif action == 'getAffiliateSites':
+            campaign_id = int(re.search(r'<campaignID[^>]*>(\d+)<', request).group(1))
+            # with shared sites, all campaigns return the same affiliate sites
+            first_id = 1 if self.server.shared_affiliate_sites else campaign_id * 100000
+            items = ''.join(affiliate_site(first_id + i) for i in range(self.server.affiliate_sites))
+            payload = (f'<ns1:getAffiliateSitesResponse><affiliateSites xsi:type="ns1:AffiliateSiteArray"'
+                       f' SOAP-ENC:arrayType="ns1:AffiliateSite[{self.server.affiliate_sites}]">{items}'
+                       '</affiliateSites></ns1:getAffiliateSitesResponse>')
+        elif action == 'getReportCampaign':
+            campaign_id = int(re.search(r'<campaignID[^>]*>(\d+)<', request).group(1))
+            # the campaigns before the ended ones are empty
+            last_empty = self.server.campaigns - self.server.ended_campaigns
+            payload = report_campaign(empty=last_empty - self.server.empty_campaigns < campaign_id <= last_empty)
+        elif action == 'getConversionTransactions':
+            campaign_id = get_option(request, 'campaignID', int)
+            date_from = get_option(request, 'registrationDateFrom', datetime.fromisoformat)
+            date_to = get_option(request, 'registrationDateTo', datetime.fromisoformat)
+            offset = get_option(request, 'offset', int) or 0
+            limit = get_option(request, 'limit', int) or 100
+            transactions = [(transaction_id, registration_date) for transaction_id, registration_date
+                            in get_transaction_dates(campaign_id, self.server.transactions)
+                            if (date_from is None or registration_date >= date_from)
+                            and (date_to is None or registration_date < date_to)][offset:offset + limit]
+            items = ''.join(conversion_transaction(campaign_id, transaction_id, registration_date)
+                            for transaction_id, registration_date in transactions)
+            payload = ('<ns1:getConversionTransactionsResponse><conversionTransactions'
+                       ' xsi:type="ns1:ConversionTransactionArray"'
+                       f' SOAP-ENC:arrayType="ns1:ConversionTransaction[{len(transactions)}]">{items}'
+                       '</conversionTransactions></ns1:getConversionTransactionsResponse>')
+        else:
+            self.send_body(400, b'')
+            return
+        self.send_body(200, ENVELOPE.format(payload).encode('utf-8'))
+
+
+class FakeTradeTrackerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, campaigns=10, affiliate_sites=50, latency=0.0, fault_rate=0.0,
+                 shared_affiliate_sites=False, ended_campaigns=0, empty_campaigns=0, transactions=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), FakeTradeTrackerHandler)
+        self.campaigns = campaigns
+        self.affiliate_sites = affiliate_sites
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.shared_affiliate_sites = shared_affiliate_sites
+        self.ended_campaigns = ended_campaigns
+        self.empty_campaigns = empty_campaigns
+        self.transactions = transactions
+        self.request_counts = {}
+        self.lock = threading.Lock()
+        with open(WSDL_PATH) as file:
+            wsdl = file.read()
+        self.wsdl = wsdl.replace(WSDL_LOCATION, f'{self.url}/soap/merchant').encode('utf-8')
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--campaigns', type=int, default=10)
+    parser.add_argument('--affiliate-sites', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--fault-rate', type=float, default=0.0, help='share of failed calls')
+    parser.add_argument('--shared-affiliate-sites', action='store_true',
+                        help='all campaigns return the same affiliate sites')
+    parser.add_argument('--ended-campaigns', type=int, default=0, help='number of campaigns stopped 60 days ago')
+    parser.add_argument('--empty-campaigns', type=int, default=0, help='number of campaigns with empty reports')
+    parser.add_argument('--transactions', type=int, default=0, help='conversion transactions per campaign')
+    args = parser.parse_args()
+
+    server = FakeTradeTrackerServer(args.port, args.campaigns, args.affiliate_sites,
+                                    args.latency, args.fault_rate, args.shared_affiliate_sites,
+                                    args.ended_campaigns, args.empty_campaigns, args.transactions)
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of a full sync against the fake TradeTracker SOAP server.
+
+Starts fake_server.py in a separate process, runs tap_tradetracker.sync.sync()
+end to end with all streams selected and reports the wall time, the number of
+SOAP requests, the peak RSS, the number of records and records per second.
+The Singer messages are counted and discarded instead of written to stdout.
+
+Usage: run_benchmark.py [--campaigns 10] [--affiliate-sites 50] [--shared-affiliate-sites] [--latency 0]
+                        [--ended-campaigns 0] [--empty-campaigns 0] [--transactions 0]
+                        [--days 30] [--accounts 1] [--config extra.json] [--output result.json]
+                        [--profile profile-dir]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import urllib.request
+from datetime import timedelta
+
+from singer import utils
+from singer.catalog import Catalog
+
+from tap_tradetracker import output
+from tap_tradetracker.discover import discover
+from tap_tradetracker.sync import sync
+from tap_tradetracker.timing import TIMINGS
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_server.py')
+
+
+class CountingOutput:
+    """Replaces stdout: counts the Singer messages instead of writing them"""
+    def __init__(self):
+        self.messages = 0
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.messages += data.count('\n')
+        self.records += data.count('"RECORD"')
+        self.bytes += len(data)
+
+    def flush(self):
+        pass
+
+
+def start_fake_server(args):
+    process = subprocess.Popen([sys.executable, FAKE_SERVER,
+                                '--campaigns', str(args.campaigns),
+                                '--affiliate-sites', str(args.affiliate_sites),
+                                '--latency', str(args.latency),
+                                '--fault-rate', str(args.fault_rate),
+                                '--ended-campaigns', str(args.ended_campaigns),
+                                '--empty-campaigns', str(args.empty_campaigns),
+                                '--transactions', str(args.transactions)]
+                               + (['--shared-affiliate-sites'] if args.shared_affiliate_sites else []),
+                               stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    return process, f'http://127.0.0.1:{port}'
+
+
+def get_request_counts(url):
+    with urllib.request.urlopen(f'{url}/stats') as response:
+        return json.load(response)
+
+
+def get_catalog():
+    """Returns the discovered catalog with all streams selected"""
+    catalog = discover().to_dict()
+    for stream in catalog['streams']:
+        for entry in stream['metadata']:
+            if not entry['breadcrumb']:
+                entry['metadata']['selected'] = True
+    return Catalog.from_dict(catalog)
+
+
+def get_config(args, url):
+    config = {
+        'customer_id': 1,
+        'passphrase': [f'passphrase-{i}' for i in range(args.accounts)],
+        'wsdl': f'{url}/soap/merchant?wsdl',
+        'start_date': utils.strftime(utils.now() - timedelta(days=args.days)),
+        'attribution_window': args.attribution_window,
+    }
+    if args.config:
+        with open(args.config) as file:
+            config.update(json.load(file))
+    if args.profile:
+        config['profile_path'] = args.profile
+    return config
+
+
+def run(args):
+    process, url = start_fake_server(args)
+    try:
+        config = get_config(args, url)
+        catalog = get_catalog()
+        counting_output = CountingOutput()
+        output.WRITER.output = counting_output
+
+        start = time.perf_counter()
+        sync(config=config, catalog=catalog, state={})
+        wall_time = time.perf_counter() - start
+
+        request_counts = get_request_counts(url)
+    finally:
+        output.WRITER.output = None
+        process.terminate()
+        process.wait()
+
+    stages = {}
+    for entry in TIMINGS.summary():
+        stages[entry['stage']] = round(stages.get(entry['stage'], 0) + entry['total_seconds'], 6)
+
+    return {
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'wall_time_seconds': round(wall_time, 3),
+        'requests': sum(request_counts.values()),
+        'requests_by_action': request_counts,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'messages': counting_output.messages,
+        'output_bytes': counting_output.bytes,
+        'records': counting_output.records,
+        'records_per_second': round(counting_output.records / wall_time, 1),
+        'stage_seconds': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--campaigns', type=int, default=10)
+    parser.add_argument('--affiliate-sites', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per SOAP response')
+    parser.add_argument('--fault-rate', type=float, default=0.0, help='share of failed SOAP calls')
+    parser.add_argument('--shared-affiliate-sites', action='store_true',
+                        help='all campaigns return the same affiliate sites')
+    parser.add_argument('--ended-campaigns', type=int, default=0, help='campaigns stopped 60 days ago')
+    parser.add_argument('--empty-campaigns', type=int, default=0, help='campaigns with empty reports')
+    parser.add_argument('--transactions', type=int, default=0, help='conversion transactions per campaign')
+    parser.add_argument('--days', type=int, default=30, help='days to sync (start_date)')
+    parser.add_argument('--attribution-window', type=int, default=7)
+    parser.add_argument('--accounts', type=int, default=1, help='number of passphrases')
+    parser.add_argument('--config', help='JSON file with additional tap config')
+    parser.add_argument('--output', help='write the result to this JSON file')
+    parser.add_argument('--profile', help='profile the sync, write the profiles to this directory')
+    args = parser.parse_args()
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
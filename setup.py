@@ -28,6 +28,12 @@ setup(name='tap-tradetracker',
           'dev': [
               'pylint',
               'ipdb',
+          ],
+          'fast': [
+              'orjson',
+          ],
+          'parquet': [
+              'pyarrow',
           ]
       },
 )
\ No newline at end of file
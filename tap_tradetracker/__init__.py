@@ -4,9 +4,8 @@ import json
 
 import singer
 
-from tap_tradetracker.client import TradeTrackerClient
-from tap_tradetracker.discover import discover
-from tap_tradetracker.sync import sync
+# The modes import their modules lazily, so discovery does not load suds and
+# the sync modules.
 
 LOGGER = singer.get_logger()
 
@@ -16,6 +15,7 @@ REQUIRED_CONFIG_KEYS = [
 ]
 
 def do_discover():
+    from tap_tradetracker.discover import discover
     LOGGER.info('Starting discover')
     catalog = discover()
     json.dump(catalog.to_dict(), sys.stdout, indent=2)
@@ -36,7 +36,13 @@ def main():
 
     if parsed_args.discover:
         do_discover()
+    elif parsed_args.catalog and config.get('explain', False):
+        from tap_tradetracker.explain import explain
+        explain(config=config,
+                catalog=parsed_args.catalog,
+                state=state)
     elif parsed_args.catalog:
+        from tap_tradetracker.sync import sync
         sync(config=config,
             catalog=parsed_args.catalog,
             state=state)
@@ -0,0 +1,191 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import singer
+from singer import utils
+from singer.catalog import Catalog
+from singer.utils import strptime_to_utc, strftime
+
+from tap_tradetracker import output
+from tap_tradetracker.cache import ReportCache
+from tap_tradetracker.streams import STREAMS
+from tap_tradetracker.sync import (OUTPUT_LOCK, StreamPipeline, fetch_endpoint, get_bookmark, get_bucket_end,
+                                   get_client, sync_endpoint, write_bookmark, write_schema)
+
+LOGGER = singer.get_logger()
+
+# Parallel backfill (config: backfill_workers): the final days of campaign_report
+# before the attribution window are split into work units of a set of campaigns and
+# a date range, which are synced by a pool of processes. Each unit keeps its own
+# state shard and writes its messages to a file, which is copied to the output when
+# the unit is completed. The state shards are merged into the state: a campaign's
+# bookmark moves to the end of its last completed unit before its first failed unit.
+# The regular sync then continues from the merged bookmarks.
+STREAM_NAME = 'campaign_report'
+ENDPOINT_CONFIG = STREAMS['campaigns']['children'][STREAM_NAME]
+BOOKMARK_FIELD = 'date'
+
+BackfillUnit = namedtuple('BackfillUnit', ['passphrase', 'account', 'campaign_ids', 'start', 'end'])
+
+
+def plan_backfill(config, state, passphrase, account, campaign_ids):
+    """Returns the work units [BackfillUnit] of the campaigns of an account"""
+    # the backfill ends at the start of the first day of the attribution window
+    attribution_start = (utils.now() - timedelta(days=config.get('attribution_window', 30))) \
+        .replace(hour=0, minute=0, second=0, microsecond=0)
+    shard_days = config.get('backfill_shard_days', 90)
+    # the units end at the end of a report window bucket, so they aggregate the same days
+    # as a regular sync (see get_date_windows)
+    bucket_days = config.get('report_backfill_window_size', ENDPOINT_CONFIG.get('date_window_size'))
+    campaigns_per_unit = config.get('backfill_campaigns_per_unit', 10)
+
+    # campaigns with the same bookmark share their work units
+    campaigns_by_start = defaultdict(list)
+    for campaign_id in campaign_ids:
+        last_datetime = get_bookmark(state, STREAM_NAME, config.get('start_date'), BOOKMARK_FIELD, campaign_id,
+                                     account)
+        campaigns_by_start[strptime_to_utc(last_datetime)].append(campaign_id)
+
+    units = []
+    for start, campaign_ids in sorted(campaigns_by_start.items()):
+        for i in range(0, len(campaign_ids), campaigns_per_unit):
+            shard_start = start
+            while shard_start < attribution_start:
+                shard_end = min(get_bucket_end(shard_start + timedelta(days=shard_days - 1), bucket_days),
+                                attribution_start)
+                units.append(BackfillUnit(passphrase, account, campaign_ids[i:i + campaigns_per_unit],
+                                          shard_start, shard_end))
+                shard_start = shard_end
+    return units
+
+
+def sync_backfill_unit(config, catalog_dict, unit, output_path):
+    """
+    Syncs a work unit (in a pool process): the messages are written to output_path.
+    Returns the state shard and the number of records.
+    """
+    catalog = Catalog.from_dict(catalog_dict)
+    output.configure(config)
+    # the state shard is returned, not written
+    output.WRITER.hold_state = True
+    record_sink = None
+    if config.get('output_format', 'singer') == 'parquet':
+        from tap_tradetracker.parquet import ParquetSink
+        record_sink = ParquetSink(config['parquet_path'],
+                                  catalog,
+                                  row_group_size=config.get('parquet_row_group_size', 10000),
+                                  partition=config.get('parquet_partition', 'month'),
+                                  max_open_files=config.get('parquet_max_open_files', 64),
+                                  max_buffered_rows=config.get('parquet_max_buffered_rows', 100000))
+        output.set_record_sink(record_sink)
+    report_cache = ReportCache(config['report_cache_path']) if config.get('report_cache_path') else None
+    unit_config = dict(config, resume_progress=False, max_campaign_workers=1)
+
+    state = {}
+    total_records = 0
+    with open(output_path, 'w') as file:
+        output.WRITER.output = file
+        try:
+            with get_client(unit_config, unit.passphrase, report_cache) as client:
+                client.authenticate()
+                pipelines = {STREAM_NAME: StreamPipeline(catalog, STREAM_NAME)}
+                for campaign_id in unit.campaign_ids:
+                    write_bookmark(state, STREAM_NAME, strftime(unit.start), BOOKMARK_FIELD, campaign_id,
+                                   unit.account)
+                    fetched_windows = fetch_endpoint(client, unit_config, state, STREAM_NAME, ENDPOINT_CONFIG,
+                                                     parent_id=campaign_id, end_datetime=unit.end)
+                    total_records += sync_endpoint(client=client,
+                                                   config=unit_config,
+                                                   catalog=catalog,
+                                                   state=state,
+                                                   stream_name=STREAM_NAME,
+                                                   endpoint_config=ENDPOINT_CONFIG,
+                                                   sync_streams=[STREAM_NAME],
+                                                   selected_streams=[STREAM_NAME],
+                                                   parent_id=campaign_id,
+                                                   fetched_windows=fetched_windows,
+                                                   pipelines=pipelines)
+            if record_sink:
+                record_sink.close()
+        except Exception:
+            # the files of a failed unit are removed
+            if record_sink:
+                record_sink.abort()
+            raise
+        finally:
+            output.flush()
+            if report_cache:
+                report_cache.close()
+
+    return state, total_records
+
+
+def run_backfill(config, catalog, state):
+    passphrases = config['passphrase']
+    if not isinstance(passphrases, list):
+        passphrases = [passphrases]
+
+    units = []
+    for passphrase in passphrases:
+        with get_client(config, passphrase) as client:
+            client.authenticate()
+            campaign_ids = [campaign['ID'] for campaign in client.get_campaigns()]
+        units.extend(plan_backfill(config, state, passphrase, client.account_label, campaign_ids))
+    if not units:
+        return
+
+    backfill_workers = config.get('backfill_workers')
+    LOGGER.info(f'Backfill {STREAM_NAME}: {len(units)} work units, {backfill_workers} processes')
+    write_schema(catalog, STREAM_NAME)
+
+    shard_states = {}
+    errors = []
+    output_dir = tempfile.mkdtemp(prefix='tap-tradetracker-backfill-')
+    try:
+        # spawned processes: the threads of this process are not forked
+        with ProcessPoolExecutor(max_workers=backfill_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(sync_backfill_unit, config, catalog.to_dict(), unit,
+                                       os.path.join(output_dir, f'unit-{i}.jsonl')): i
+                       for i, unit in enumerate(units)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    shard_state, record_count = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    LOGGER.error(f'Backfill unit {i} ({units[i].start.date()} - {units[i].end.date()}) failed: {err!r}')
+                    errors.append(err)
+                    continue
+                shard_states[i] = shard_state
+                with open(os.path.join(output_dir, f'unit-{i}.jsonl')) as file, OUTPUT_LOCK:
+                    output.write_serialized(file)
+                LOGGER.info(f'Backfill unit {i} completed: {record_count} records '
+                            f'({len(shard_states)}/{len(units)} units)')
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    # merge the state shards: the units of a campaign in date order, up to the first failed one
+    units_by_campaign = defaultdict(list)
+    for i, unit in sorted(enumerate(units), key=lambda item: item[1].start):
+        for campaign_id in unit.campaign_ids:
+            units_by_campaign[(unit.account, campaign_id)].append(i)
+    for (account, campaign_id), unit_indexes in units_by_campaign.items():
+        bookmark = None
+        for i in unit_indexes:
+            if i not in shard_states:
+                break
+            # the date range of a completed unit is synced up to its end
+            shard_bookmark = get_bookmark(shard_states[i], STREAM_NAME, None, BOOKMARK_FIELD, campaign_id, account)
+            bookmark = units[i].end
+            if shard_bookmark and strptime_to_utc(shard_bookmark) > bookmark:
+                bookmark = strptime_to_utc(shard_bookmark)
+        if bookmark:
+            write_bookmark(state, STREAM_NAME, strftime(bookmark), BOOKMARK_FIELD, campaign_id, account)
+
+    if errors:
+        raise errors[0]
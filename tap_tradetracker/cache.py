@@ -0,0 +1,95 @@
+import json
+import sqlite3
+import hashlib
+import threading
+
+import singer
+
+LOGGER = singer.get_logger()
+
+
+class ReportCache:
+    """
+    On-disk (SQLite) cache of report responses, keyed by account, campaign and
+    date range. Each entry keeps a hash of its content, so a caller can tell
+    whether a fresh response differs from the cached one.
+    Reports are put in a pending table first and are compared with the committed
+    reports only: commit() moves the pending reports to the committed ones once
+    their records are synced (the sync succeeded), discard_pending() drops them.
+    The cache can be shared by the threads of all accounts.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        for table in ('report', 'pending_report'):
+            self.__connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} ('
+                ' account TEXT NOT NULL,'
+                ' campaign_id INTEGER NOT NULL,'
+                ' date_from TEXT NOT NULL,'
+                ' date_to TEXT NOT NULL,'
+                ' content TEXT NOT NULL,'
+                ' content_hash TEXT NOT NULL,'
+                ' PRIMARY KEY (account, campaign_id, date_from, date_to))')
+        self.__connection.commit()
+
+    def get(self, account, campaign_id, date_from, date_to):
+        """Returns the committed report, or None if it is not cached"""
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT content FROM report'
+                ' WHERE account = ? AND campaign_id = ? AND date_from = ? AND date_to = ?',
+                (account, campaign_id, date_from.isoformat(), date_to.isoformat())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, account, campaign_id, date_from, date_to, report):
+        """
+        Caches a report as pending; returns whether it is new or its content changed
+        since it was committed
+        """
+        content = json.dumps(report, sort_keys=True)
+        content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        key = (account, campaign_id, date_from.isoformat(), date_to.isoformat())
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT content_hash FROM report'
+                ' WHERE account = ? AND campaign_id = ? AND date_from = ? AND date_to = ?',
+                key).fetchone()
+            changed = row is None or row[0] != content_hash
+            if changed:
+                self.__connection.execute(
+                    'INSERT OR REPLACE INTO pending_report VALUES (?, ?, ?, ?, ?, ?)',
+                    key + (content, content_hash))
+                self.__connection.commit()
+        return changed
+
+    def commit(self):
+        """Commits the pending reports (after their records are synced)"""
+        with self.__lock:
+            cursor = self.__connection.execute('INSERT OR REPLACE INTO report SELECT * FROM pending_report')
+            self.__connection.execute('DELETE FROM pending_report')
+            self.__connection.commit()
+        LOGGER.info(f'Report cache: committed {cursor.rowcount} reports')
+
+    def discard_pending(self):
+        """Drops the pending reports (of a failed sync)"""
+        with self.__lock:
+            self.__connection.execute('DELETE FROM pending_report')
+            self.__connection.commit()
+
+    def evict(self, before_date):
+        """Removes all reports which end before the given date"""
+        with self.__lock:
+            cursor = self.__connection.execute(
+                'DELETE FROM report WHERE date_to < ?', (before_date.isoformat(),))
+            self.__connection.execute(
+                'DELETE FROM pending_report WHERE date_to < ?', (before_date.isoformat(),))
+            self.__connection.commit()
+        LOGGER.info(f'Report cache: evicted {cursor.rowcount} reports before {before_date}')
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
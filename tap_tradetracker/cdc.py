@@ -0,0 +1,71 @@
+import os
+import json
+import hashlib
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# Change-data-capture for FULL_TABLE streams: a fingerprint index
+#   {stream_name: {scope: {record_key: fingerprint}}}
+# remembers the records of the last sync, so only inserted and changed records
+# are emitted (and deleted records can be emitted as tombstones).
+# The scope is the set of records returned by one API call: the campaigns of an
+# account, or the affiliate sites of a campaign.
+
+
+def get_fingerprint(record):
+    """Returns a compact hash of the content of a (transformed) record"""
+    content = json.dumps(record, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+def get_record_key(record, key_properties):
+    return ':'.join(str(record.get(key_property)) for key_property in key_properties)
+
+
+def load_index(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_index(path, index):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(index, file, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+class ChangeTracker:
+    """Tracks the records of one stream scope during a sync against the fingerprint index"""
+    def __init__(self, index, stream_name, scope, key_properties):
+        self.index = index
+        self.stream_name = stream_name
+        self.scope = scope
+        self.key_properties = key_properties
+        self.previous = index.get(stream_name, {}).get(scope, {})
+        self.current = {}
+
+    def is_changed(self, record):
+        """Returns whether a record is new or changed since the last sync"""
+        key = get_record_key(record, self.key_properties)
+        fingerprint = get_fingerprint(record)
+        self.current[key] = fingerprint
+        return self.previous.get(key) != fingerprint
+
+    def get_deleted_keys(self):
+        """Returns the keys of the records of the last sync which were not synced now"""
+        return [key for key in self.previous if key not in self.current]
+
+    def get_tombstone(self, key, deleted_at):
+        """Returns a record marking the record with the given key as deleted"""
+        values = key.split(':', len(self.key_properties) - 1)
+        tombstone = dict(zip(self.key_properties, values))
+        tombstone['_sdc_deleted_at'] = deleted_at
+        return tombstone
+
+    def commit(self):
+        """Replaces the fingerprints of the scope in the index with the synced ones"""
+        self.index.setdefault(self.stream_name, {})[self.scope] = self.current
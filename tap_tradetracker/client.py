@@ -1,11 +1,43 @@
+import os
+import time
+import random
+import socket
+import hashlib
+import datetime
+import threading
+from http.client import HTTPException
+from urllib.error import URLError
+from functools import lru_cache
+from typing import Iterator
+from urllib.parse import urlparse
+
+import humps
+from suds import WebFault
 from suds.plugin import MessagePlugin
-from suds.client import Client
+from suds.transport import TransportError
+from suds.sudsobject import Object
+from suds.client import Client, ServiceSelector
+from suds.options import Options
+from suds.cache import ObjectCache
+from suds.transport.https import HttpAuthenticated
 
 import singer
 
+from tap_tradetracker.timing import TIMINGS
+from tap_tradetracker.transport import ConnectionPool, PooledHttpTransport
+
 WSDL_URL = 'https://ws.tradetracker.com/soap/merchant?wsdl'
 LOGGER = singer.get_logger()
 
+# errors and HTTP status codes of a SOAP call which are worth a retry
+TRANSIENT_ERRORS = (TransportError, URLError, HTTPException, socket.timeout, ConnectionError)
+TRANSIENT_HTTP_STATUS = (408, 429, 500, 502, 503, 504)
+
+# parsed WSDL clients shared by all TradeTrackerClient instances of this process,
+# keyed by (wsdl_url, cache_dir, cache_days)
+_WSDL_CLIENTS = {}
+_WSDL_CLIENTS_LOCK = threading.Lock()
+
 
 class SoapFixer(MessagePlugin):
     def marshalled(self, context):
@@ -33,37 +65,137 @@ def basic_sobject_to_dict(obj):
     return data
 
 
-def sobject_to_dict(obj, key_to_lower=False, json_serialize=False):
+@lru_cache(maxsize=None)
+def get_record_key(field):
+    """Returns the snake_case record key of a WSDL field name (cached per field name)"""
+    return humps.decamelize(field)
+
+
+def sobject_to_record(obj):
     """
-    Converts a suds object to a dict.
-    :param json_serialize: If set, changes date and time types to iso string.
-    :param key_to_lower: If set, changes index key name to lower case.
+    Converts a suds object to a JSON-ready dict in a single pass.
+    Keys are converted to snake_case (like humps.decamelize), dates and
+    times are serialized as ISO 8601 strings.
     :param obj: suds object
     :return: dict object
     """
-    import datetime
+    if isinstance(obj, Object):
+        return {get_record_key(field): sobject_to_record(getattr(obj, field))
+                for field in obj.__keylist__}
+    if isinstance(obj, list):
+        return [sobject_to_record(item) for item in obj]
+    if isinstance(obj, (datetime.datetime, datetime.time, datetime.date)):
+        return obj.isoformat()
+    return obj
+
+
+def get_wsdl_url(wsdl):
+    """Returns a loadable WSDL URL; a local file path is converted to a file:// URL
+    so the tap can run offline against a stored copy of the WSDL.
+    """
+    if urlparse(wsdl).scheme in ('http', 'https', 'file'):
+        return wsdl
+    return 'file://' + os.path.abspath(os.path.expanduser(wsdl))
+
+
+def get_wsdl_client(wsdl=WSDL_URL, cache_dir=None, cache_days=1):
+    """
+    Returns a suds client for the WSDL which shares the parsed WSDL/type model with
+    every other client of this process. The WSDL is only downloaded and parsed once
+    per process; across runs the parsed model is read from the on-disk suds object
+    cache (versioned by suds, expired after cache_days, 0 means never).
+    :param wsdl: WSDL URL or local file path
+    :param cache_dir: directory of the on-disk cache (default: suds temp directory)
+    :param cache_days: days until the cached WSDL is downloaded again
+    :return: suds client (clone with its own options and session)
+    """
+    wsdl_url = get_wsdl_url(wsdl)
+    key = (wsdl_url, cache_dir, cache_days)
+    with _WSDL_CLIENTS_LOCK:
+        client = _WSDL_CLIENTS.get(key)
+        if client is None:
+            LOGGER.info(f'Loading WSDL {wsdl_url}')
+            with TIMINGS.timed('wsdl_load'):
+                # cachingpolicy 1: the parsed WSDL is cached, not only its XML documents
+                client = Client(wsdl_url,
+                                cache=ObjectCache(location=cache_dir, days=cache_days),
+                                cachingpolicy=1,
+                                plugins=[SoapFixer()])
+            _WSDL_CLIENTS[key] = client
+    return clone_client(client)
+
+
+def clone_client(client):
+    """
+    Returns a new suds client sharing the parsed WSDL of the given client, but with
+    its own options and transport (and therefore its own session cookies).
+    suds' own Client.clone() deep-copies the options, which fails on Python 3.
+    :param client: suds client
+    :return: suds client
+    """
+    clone = Client.__new__(Client)
+    clone.options = Options()
+    clone.options.transport = HttpAuthenticated()
+    clone.set_options(cache=client.options.cache, plugins=client.options.plugins)
+    clone.wsdl = client.wsdl
+    clone.factory = client.factory
+    clone.service = ServiceSelector(clone, client.wsdl.services)
+    clone.sd = client.sd
+    clone.messages = dict(tx=None, rx=None)
+    return clone
 
-    if not hasattr(obj, '__keylist__'):
-        if json_serialize and isinstance(obj, (datetime.datetime, datetime.time, datetime.date)):
-            LOGGER.info(f'datetime: {obj}')
-            return obj.isoformat()
-        else:
-            return obj
-    data = {}
-    fields = obj.__keylist__
-    for field in fields:
-        val = getattr(obj, field)
-        if key_to_lower:
-            field = field.lower()
-        if isinstance(val, list):
-            data[field] = []
-            for item in val:
-                data[field].append(sobject_to_dict(item, json_serialize=json_serialize))
-        elif isinstance(val, (datetime.datetime, datetime.time, datetime.date)):
-            data[field] = val.isoformat()
-        else:
-            data[field] = sobject_to_dict(val, json_serialize=json_serialize)
-    return data
+
+def is_session_expired(err):
+    """Returns whether a SOAP fault is caused by a missing or expired session"""
+    fault_string = str(getattr(err.fault, 'faultstring', '')).lower()
+    return 'authenticat' in fault_string or 'session' in fault_string
+
+
+def is_transient_error(err):
+    """Returns whether a failed SOAP call is worth a retry"""
+    if isinstance(err, TRANSIENT_ERRORS):
+        return True
+    # suds raises HTTP errors (other than SOAP faults) as Exception((status, reason))
+    if type(err) is Exception and err.args and isinstance(err.args[0], tuple):  # pylint: disable=unidiomatic-typecheck
+        return err.args[0][0] in TRANSIENT_HTTP_STATUS
+    return False
+
+
+def get_account_key(customer_id, passphrase):
+    """Returns the key identifying an account (without storing the passphrase)"""
+    return hashlib.sha1(f'{customer_id}:{passphrase}'.encode('utf-8')).hexdigest()
+
+
+def get_account_label(customer_id, passphrase):
+    """Returns the short key of an account, which indexes its bookmarks in the state"""
+    return get_account_key(customer_id, passphrase)[:16]
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: allows `rate` calls per second on average and bursts
+    of up to `burst` calls. A rate of None (or 0) disables the limit.
+    """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.__tokens = self.burst
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
 
 
 class TradeTrackerClient:
@@ -72,49 +204,243 @@ class TradeTrackerClient:
                  passphrase,
                  sandbox=False,
                  locale=None,
-                 demo=False):
+                 demo=False,
+                 wsdl=WSDL_URL,
+                 wsdl_cache_dir=None,
+                 wsdl_cache_days=1,
+                 timeout=90,
+                 max_retries=5,
+                 backoff_factor=2,
+                 max_backoff=60,
+                 max_requests_per_second=None,
+                 keep_alive=True,
+                 pool_size=4,
+                 accept_gzip=False,
+                 report_cache=None,
+                 report_final_after_days=None,
+                 report_changes_only=False,
+                 dedupe_affiliate_sites=False):
         self.__customer_id = customer_id
         self.__passphrase = passphrase
         self.sandbox = sandbox
         self.locale = locale
         self.demo = demo
+        self.wsdl = wsdl
+        self.wsdl_cache_dir = wsdl_cache_dir
+        self.wsdl_cache_days = wsdl_cache_days
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        # shared by all threads using this client (account)
+        self.rate_limiter = RateLimiter(max_requests_per_second)
+        self.keep_alive = keep_alive
+        self.accept_gzip = accept_gzip
+        self.connection_pool = ConnectionPool(pool_size, timeout) if keep_alive else None
+        self.report_cache = report_cache
+        self.report_final_after_days = report_final_after_days
+        self.report_changes_only = report_changes_only
+        # IDs of the affiliate sites returned so far (for all campaigns), see get_affiliate_sites()
+        self.dedupe_affiliate_sites = dedupe_affiliate_sites
+        self.affiliate_site_ids = set()
+        # identifies the account in the report cache
+        self.account_key = get_account_key(customer_id, passphrase)
+        # identifies the account in the state and the timings
+        self.account_label = get_account_label(customer_id, passphrase)
         self.__client = None
+        self.__owner_thread = None
+        self.__thread_local = threading.local()
+        self.__authenticated = False
 
     def __enter__(self):
-        self.__client = Client(WSDL_URL, plugins=[SoapFixer()])
+        self.__client = get_wsdl_client(self.wsdl,
+                                        cache_dir=self.wsdl_cache_dir,
+                                        cache_days=self.wsdl_cache_days)
+        self.__set_options(self.__client)
+        self.__owner_thread = threading.current_thread()
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        pass
+        if self.connection_pool:
+            self.connection_pool.close()
+
+    def __set_options(self, client):
+        if self.keep_alive:
+            client.set_options(transport=PooledHttpTransport(self.connection_pool,
+                                                             accept_gzip=self.accept_gzip))
+        client.set_options(timeout=self.timeout)
+
+    def __get_client(self):
+        """
+        Returns the suds client for the current thread. suds clients are not
+        thread-safe, so other threads than the one which entered the client get
+        their own clone with an own session, authenticated on first use.
+        """
+        if threading.current_thread() is self.__owner_thread:
+            return self.__client
+        client = getattr(self.__thread_local, 'client', None)
+        if client is None:
+            client = clone_client(self.__client)
+            self.__set_options(client)
+            self.__thread_local.client = client
+            if self.__authenticated:
+                self.__authenticate(client)
+        return client
+
+    def __call(self, client, method, *args, reauthenticate=True, **kwargs):
+        """
+        Calls a service method of the SOAP API through the rate limiter.
+        Transient errors are retried up to max_retries times with exponential backoff
+        and jitter; on a fault caused by an expired session the client is
+        authenticated again and the call is retried. The duration of the call
+        (including retries) is added to the timings of the method.
+        """
+        with TIMINGS.timed(method, account=self.account_label):
+            return self.__call_with_retries(client, method, *args, reauthenticate=reauthenticate, **kwargs)
+
+    def __call_with_retries(self, client, method, *args, reauthenticate=True, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.rate_limiter.acquire()
+            try:
+                return getattr(client.service, method)(*args, **kwargs)
+            except WebFault as err:
+                if not reauthenticate or not is_session_expired(err) or attempt > self.max_retries:
+                    raise
+                LOGGER.warning(f'{method}: session expired ({err}), authenticate again')
+                self.__authenticate(client)
+            except Exception as err:
+                if not is_transient_error(err) or attempt > self.max_retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff_factor * 2 ** (attempt - 1))
+                delay = random.uniform(delay / 2, delay)
+                LOGGER.warning(f'{method}: {err!r}, retry {attempt}/{self.max_retries} in {delay:.1f}s')
+                time.sleep(delay)
+
+    def __authenticate(self, client):
+        self.__call(client,
+                    'authenticate',
+                    customerID=self.__customer_id,
+                    passphrase=self.__passphrase,
+                    sandbox=self.sandbox,
+                    locale=self.locale,
+                    demo=self.demo,
+                    reauthenticate=False)
+
+    def __convert(self, objects, stream_name):
+        """Converts suds objects to records one by one; the total conversion time is added to the timings"""
+        duration = 0.0
+        count = 0
+        try:
+            for obj in objects:
+                start = time.perf_counter()
+                record = sobject_to_record(obj)
+                duration += time.perf_counter() - start
+                count += 1
+                yield record
+        finally:
+            TIMINGS.add('convert', duration, records=count, stream=stream_name, account=self.account_label)
 
     def authenticate(self):
-        self.__client.service.authenticate(customerID=self.__customer_id,
-                                           passphrase=self.__passphrase,
-                                           sandbox=self.sandbox,
-                                           locale=self.locale,
-                                           demo=self.demo)
-
-    def get_campaigns(self) -> [dict]:
-        campaigns = self.__client.service.getCampaigns()
-        result = []
-        for i in range(0, len(campaigns)):
-            campaign = campaigns[i]
-            result.append(sobject_to_dict(campaign))
-        return result
-
-    def get_affiliate_sites(self, campaign_id) -> [dict]:
-        filter_options = self.__client.factory.create('AffiliateSiteFilter')
-        affiliate_sites = self.__client.service.getAffiliateSites(campaign_id, filter_options)
-        result = []
-        for i in range(0, len(affiliate_sites)):
-            affiliate_site = affiliate_sites[i]
-            result.append(sobject_to_dict(affiliate_site))
-        return result
-
-    def get_report_campaign(self, campaign_id, date_from, date_to) -> dict:
-        filter_options = self.__client.factory.create('ReportCampaignFilter')
+        self.__authenticate(self.__get_client())
+        self.__authenticated = True
+
+    def get_campaigns(self) -> Iterator[dict]:
+        """Requests the campaigns; the records are converted one by one while iterating"""
+        campaigns = self.__call(self.__get_client(), 'getCampaigns')
+        return self.__convert(campaigns, 'campaigns')
+
+    def get_affiliate_sites(self, campaign_id) -> Iterator[dict]:
+        """
+        Requests the affiliate sites of a campaign; the records are converted one by one while iterating.
+        With dedupe_affiliate_sites, sites already returned for another campaign are skipped (before
+        their conversion), so each site is returned once per client.
+        """
+        client = self.__get_client()
+        filter_options = client.factory.create('AffiliateSiteFilter')
+        affiliate_sites = self.__call(client, 'getAffiliateSites', campaign_id, filter_options)
+        if self.dedupe_affiliate_sites:
+            affiliate_sites = self.__new_affiliate_sites(affiliate_sites, campaign_id)
+        return self.__convert(affiliate_sites, 'affiliate_sites')
+
+    def __new_affiliate_sites(self, affiliate_sites, campaign_id):
+        duplicates = 0
+        for affiliate_site in affiliate_sites:
+            affiliate_site_id = getattr(affiliate_site, 'ID', None)
+            if affiliate_site_id in self.affiliate_site_ids:
+                duplicates += 1
+                continue
+            self.affiliate_site_ids.add(affiliate_site_id)
+            yield affiliate_site
+        if duplicates:
+            LOGGER.info(f'campaign {campaign_id}: skipped {duplicates} affiliate sites of other campaigns')
+
+    def get_conversion_transactions(self, campaign_id, registration_date_from, registration_date_to,
+                                    page_size=500) -> Iterator[dict]:
+        """
+        Requests the conversion transactions of a campaign registered in a date-time range, in pages
+        of page_size transactions (limit/offset, ordered by registration date). The pages are requested
+        and the records converted one by one while iterating, so only one page is held in memory.
+        """
+        pages = self.__get_conversion_transaction_pages(campaign_id, registration_date_from,
+                                                        registration_date_to, page_size)
+        return self.__convert(pages, 'conversion_transactions')
+
+    def __get_conversion_transaction_pages(self, campaign_id, registration_date_from, registration_date_to,
+                                           page_size):
+        client = self.__get_client()
+        offset = 0
+        while True:
+            filter_options = client.factory.create('ConversionTransactionFilter')
+            filter_options.registrationDateFrom = registration_date_from
+            filter_options.registrationDateTo = registration_date_to
+            filter_options.sort = 'registrationDate'
+            filter_options.sortDirection = 'asc'
+            filter_options.limit = page_size
+            filter_options.offset = offset
+            LOGGER.info(f'registration_date_from={registration_date_from} '
+                        f'registration_date_to={registration_date_to} offset={offset}')
+            transactions = self.__call(client, 'getConversionTransactions', campaign_id, filter_options) or []
+            yield from transactions
+            if len(transactions) < page_size:
+                return
+            offset += page_size
+
+    def is_report_final(self, date_to) -> bool:
+        """Returns whether a report up to date_to is final (will not change anymore)"""
+        if self.report_final_after_days is None:
+            return False
+        final_date = datetime.datetime.now(datetime.timezone.utc).date() \
+            - datetime.timedelta(days=self.report_final_after_days)
+        return date_to < final_date
+
+    def get_report_campaign(self, campaign_id, date_from, date_to, synced=False) -> dict:
+        """
+        Requests the campaign report for a date range. With a report cache, final
+        reports are served from the cache and requested reports are cached. With
+        report_changes_only, None is returned for a report of a synced date range
+        (before the bookmark) which is unchanged since it was committed to the cache
+        (by a successful sync).
+        """
+        skip_unchanged = self.report_changes_only and synced
+        if self.report_cache and self.is_report_final(date_to):
+            report = self.report_cache.get(self.account_key, campaign_id, date_from, date_to)
+            if report is not None:
+                LOGGER.info(f'date_from={date_from} date_to={date_to} (final, from cache)')
+                return None if skip_unchanged else report
+
+        client = self.__get_client()
+        filter_options = client.factory.create('ReportCampaignFilter')
         LOGGER.info(f'date_from={date_from} date_to={date_to}')
         filter_options.dateFrom = date_from
         filter_options.dateTo = date_to
-        report_data = self.__client.service.getReportCampaign(campaignID=campaign_id, options=filter_options)
-        return sobject_to_dict(report_data)
+        report_data = self.__call(client, 'getReportCampaign', campaignID=campaign_id, options=filter_options)
+        with TIMINGS.timed('convert', stream='campaign_report', account=self.account_label):
+            report = sobject_to_record(report_data)
+
+        if self.report_cache:
+            changed = self.report_cache.put(self.account_key, campaign_id, date_from, date_to, report)
+            if skip_unchanged and not changed:
+                return None
+        return report
@@ -0,0 +1,203 @@
+import os
+import sys
+import copy
+import json
+import math
+from collections import Counter
+
+import singer
+
+from tap_tradetracker.cache import ReportCache
+from tap_tradetracker.streams import flatten_streams, STREAMS
+from tap_tradetracker.sync import (get_active_period, get_client, get_report_dates, get_sync_streams,
+                                   is_parent_completed, is_stream_completed, migrate_former_accounts,
+                                   plan_date_windows)
+
+LOGGER = singer.get_logger()
+
+# Explain mode (config: explain): plans a sync without running it. The plan covers
+# the accounts × streams × campaigns × date windows a sync of the config, state and
+# catalog would request, with the number of SOAP calls and an estimated duration.
+# Only authenticate and getCampaigns are called (the campaign list of the plan).
+# The durations are the mean durations per SOAP method of the timing summary of a
+# former run (config: explain_timings_path, default: metrics_summary_path).
+STREAM_METHODS = {
+    'campaigns': 'getCampaigns',
+    'campaign_report': 'getReportCampaign',
+    'affiliate_sites': 'getAffiliateSites',
+    'conversion_transactions': 'getConversionTransactions',
+}
+
+# seconds per SOAP call without recorded timings
+DEFAULT_CALL_SECONDS = 0.5
+
+
+def load_recorded_timings(path):
+    """
+    Returns the mean seconds per SOAP method and the mean number of records per
+    date window of each stream from a timing summary (see Timings.write_summary).
+    """
+    with open(path) as file:
+        summary = json.load(file)
+    calls = {}
+    records = {}
+    for entry in summary:
+        if entry['stream'] is None:
+            count, total = calls.get(entry['stage'], (0, 0.0))
+            calls[entry['stage']] = (count + entry['count'], total + entry['total_seconds'])
+        elif entry['stage'] == 'convert':
+            count, total = records.get(entry['stream'], (0, 0))
+            records[entry['stream']] = (count + entry['count'], total + entry.get('records', 0))
+    return ({stage: total / count for stage, (count, total) in calls.items() if count},
+            {stream: total / count for stream, (count, total) in records.items() if count})
+
+
+def plan_parent(config, state, client, report_cache, stream_name, endpoint_config, campaign, records_per_window):
+    """Returns the plan of a child stream for one campaign"""
+    parent_id = campaign['ID']
+    date_windows = plan_date_windows(config, state, client.account_label, stream_name, endpoint_config,
+                                     parent_id, active_period=get_active_period(campaign))
+    requested = [(start_window, end_window) for start_window, end_window, is_requested in date_windows
+                 if is_requested]
+
+    cached = 0
+    if report_cache and stream_name.endswith('_report'):
+        for start_window, end_window in requested:
+            date_from, date_to = get_report_dates(start_window, end_window)
+            if client.is_report_final(date_to) and \
+                    report_cache.get(client.account_key, parent_id, date_from, date_to) is not None:
+                cached += 1
+
+    # paged endpoints: at least one call per window, more for the recorded number of records
+    calls_per_window = 1
+    page_size = config.get('{}_page_size'.format(stream_name), endpoint_config.get('page_size'))
+    if page_size and records_per_window.get(stream_name):
+        calls_per_window = max(1, math.ceil(records_per_window[stream_name] / page_size))
+
+    return {
+        'parent_id': parent_id,
+        'date_windows': len(date_windows),
+        'skipped_windows': len(date_windows) - len(requested),
+        'cached_windows': cached,
+        'calls': (len(requested) - cached) * calls_per_window,
+        'from': date_windows[0][0].date().isoformat() if date_windows else None,
+        'to': date_windows[-1][1].date().isoformat() if date_windows else None,
+    }
+
+
+def explain_account(config, state, passphrase, sync_streams, report_cache, records_per_window):
+    """Returns the plan of an account: its streams, campaigns and date windows, with the calls per method"""
+    with get_client(config, passphrase) as client:
+        client.authenticate()
+        campaigns = list(client.get_campaigns())
+    account = client.account_label
+    resume = config.get('resume_progress', True)
+    calls = Counter(authenticate=1)
+    plan = {'account': account, 'campaigns': len(campaigns), 'streams': {}}
+
+    for stream_name, endpoint_config in STREAMS.items():
+        if stream_name not in sync_streams:
+            continue
+        if resume and is_stream_completed(state, account, stream_name):
+            plan['streams'][stream_name] = {'completed': True}
+            continue
+        calls[STREAM_METHODS[stream_name]] += 1
+        plan['streams'][stream_name] = {'calls': 1}
+
+        for child_stream_name, child_endpoint_config in endpoint_config.get('children', {}).items():
+            if child_stream_name not in sync_streams:
+                continue
+            completed_parents = 0
+            parents = []
+            for campaign in campaigns:
+                if resume and is_parent_completed(state, account, child_stream_name, campaign['ID']):
+                    completed_parents += 1
+                    continue
+                parents.append(plan_parent(config, state, client, report_cache, child_stream_name,
+                                           child_endpoint_config, campaign, records_per_window))
+            stream_calls = sum(parent['calls'] for parent in parents)
+            calls[STREAM_METHODS[child_stream_name]] += stream_calls
+            plan['streams'][child_stream_name] = {
+                'calls': stream_calls,
+                'date_windows': sum(parent['date_windows'] for parent in parents),
+                'skipped_windows': sum(parent['skipped_windows'] for parent in parents),
+                'cached_windows': sum(parent['cached_windows'] for parent in parents),
+                'completed_parents': completed_parents,
+                'parents': [parent for parent in parents if parent['date_windows']],
+            }
+
+    plan['calls'] = sum(calls.values())
+    plan['calls_by_method'] = dict(calls)
+    return plan
+
+
+def estimate_account_seconds(config, plan, call_seconds):
+    """Returns the estimated duration of the sync of an account"""
+    max_campaign_workers = config.get('max_campaign_workers', 1)
+    flat_streams = flatten_streams()
+    seconds = 0.0
+    for stream_name, stream_plan in plan['streams'].items():
+        stream_seconds = stream_plan.get('calls', 0) * call_seconds.get(STREAM_METHODS[stream_name],
+                                                                        DEFAULT_CALL_SECONDS)
+        # the child streams of max_campaign_workers campaigns are requested concurrently (not paged ones)
+        endpoint_config = flat_streams[stream_name]
+        if endpoint_config.get('parent') and not endpoint_config.get('page_size'):
+            stream_seconds /= max_campaign_workers
+        seconds += stream_seconds
+    seconds += plan['calls_by_method'].get('authenticate', 0) * call_seconds.get('authenticate',
+                                                                                  DEFAULT_CALL_SECONDS)
+    # the calls of an account are limited to max_requests_per_second
+    if config.get('max_requests_per_second'):
+        seconds = max(seconds, plan['calls'] / config['max_requests_per_second'])
+    return seconds
+
+
+def explain(config, catalog, state):
+    """Plans the sync of the selected streams and writes the plan as JSON to stdout; nothing is synced"""
+    state = copy.deepcopy(state)
+    migrate_former_accounts(config, state)
+    selected_streams = [stream.stream for stream in catalog.get_selected_streams(state)]
+    sync_streams = get_sync_streams(selected_streams)
+
+    timings_path = config.get('explain_timings_path', config.get('metrics_summary_path'))
+    call_seconds, records_per_window = {}, {}
+    if timings_path and os.path.exists(timings_path):
+        call_seconds, records_per_window = load_recorded_timings(timings_path)
+        LOGGER.info(f'Explain: durations of the SOAP calls recorded in {timings_path}')
+    else:
+        LOGGER.info(f'Explain: no recorded timings, {DEFAULT_CALL_SECONDS}s per SOAP call')
+
+    passphrases = config['passphrase']
+    if not isinstance(passphrases, list):
+        passphrases = [passphrases]
+
+    report_cache = ReportCache(config['report_cache_path']) if config.get('report_cache_path') else None
+    try:
+        accounts = [explain_account(config, state, passphrase, sync_streams, report_cache, records_per_window)
+                    for passphrase in passphrases]
+    finally:
+        if report_cache:
+            report_cache.close()
+
+    calls = Counter()
+    for plan in accounts:
+        plan['estimated_seconds'] = round(estimate_account_seconds(config, plan, call_seconds), 1)
+        calls.update(plan['calls_by_method'])
+    # the accounts are synced by max_account_workers threads
+    account_workers = min(config.get('max_account_workers', 1), len(accounts)) or 1
+    estimated_seconds = sum(plan['estimated_seconds'] for plan in accounts) / account_workers
+
+    result = {
+        'streams': sync_streams,
+        'calls': sum(calls.values()),
+        'calls_by_method': dict(calls),
+        'estimated_seconds': round(estimated_seconds, 1),
+        'seconds_per_call': {method: round(call_seconds.get(method, DEFAULT_CALL_SECONDS), 3)
+                             for method in calls},
+        'accounts': accounts,
+    }
+    LOGGER.info(f'Explain: {len(accounts)} countries, {result["calls"]} SOAP calls {dict(calls)}, '
+                f'estimated duration {result["estimated_seconds"]}s')
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return result
@@ -0,0 +1,168 @@
+import sys
+import json
+import time
+import threading
+
+import singer
+from singer.messages import RecordMessage, SchemaMessage, StateMessage, format_message
+
+LOGGER = singer.get_logger()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class MessageWriter:
+    """
+    Buffered writer for Singer messages.
+    Serialized messages are collected in a buffer, which is written to the output
+    when it exceeds buffer_size bytes or when flush_interval seconds have passed
+    since the last flush (checked on every write). Consecutive STATE messages are
+    coalesced: only the latest state is written, after the buffered messages, so a
+    state is never written before the records it covers. The latest state is only
+    serialized when it is flushed, so it must not be changed during a flush (the
+    sync changes the state and writes messages under the same lock).
+    A buffer_size of 0 writes (and flushes) every message immediately.
+    With hold_state, the latest state is held back until hold_state is reset
+    (e.g. until the records are written to their final destination).
+    """
+    def __init__(self, output=None, buffer_size=0, flush_interval=0, fast_json=False):
+        self.output = output
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fast_json = fast_json
+        self.hold_state = False
+        self.__buffer = []
+        self.__buffered_bytes = 0
+        self.__state = None
+        self.__last_flush = time.monotonic()
+        self.__lock = threading.RLock()
+
+    def format_message(self, message):
+        if isinstance(message, StateMessage):
+            return self.format_state(message)
+        if self.fast_json:
+            return orjson.dumps(message.asdict()).decode('utf-8')
+        return format_message(message)
+
+    def format_state(self, message):
+        """
+        Serializes a STATE message compactly with sorted keys: consecutive states (and
+        states of concurrently synced accounts) serialize in the same key order, so
+        they only differ where their values differ (small deltas for state stores).
+        """
+        if self.fast_json:
+            return orjson.dumps(message.asdict(), option=orjson.OPT_SORT_KEYS).decode('utf-8')
+        return json.dumps(message.asdict(), sort_keys=True, separators=(',', ':'))
+
+    def write_message(self, message):
+        if isinstance(message, StateMessage):
+            line = None
+        else:
+            line = self.format_message(message) + '\n'
+        with self.__lock:
+            if line is None:
+                # only the latest state is kept; it is serialized by flush()
+                self.__state = message
+            else:
+                self.__buffer.append(line)
+                self.__buffered_bytes += len(line)
+            if self.__buffered_bytes >= self.buffer_size or \
+                    time.monotonic() - self.__last_flush >= self.flush_interval:
+                self.flush()
+
+    def discard_state(self):
+        """Discards the pending (held back) state, e.g. of records which were not written"""
+        with self.__lock:
+            self.__state = None
+
+    def write_serialized(self, file):
+        """Writes the serialized messages of a file (e.g. written by another process)"""
+        with self.__lock:
+            # whole lines only: a pending state may be written after the chunk
+            for lines in iter(lambda: file.readlines(1 << 20), []):
+                chunk = ''.join(lines)
+                self.__buffer.append(chunk)
+                self.__buffered_bytes += len(chunk)
+                if self.__buffered_bytes >= self.buffer_size:
+                    self.flush()
+
+    def flush(self):
+        with self.__lock:
+            output = self.output or sys.stdout
+            if self.__state is not None and not self.hold_state:
+                self.__buffer.append(self.format_message(self.__state) + '\n')
+                self.__state = None
+            if self.__buffer:
+                output.write(''.join(self.__buffer))
+                output.flush()
+            self.__buffer = []
+            self.__buffered_bytes = 0
+            self.__last_flush = time.monotonic()
+
+
+WRITER = MessageWriter()
+
+# Alternative destination of the records (e.g. a ParquetSink), see set_record_sink()
+RECORD_SINK = None
+
+
+def configure(config):
+    """Sets the flush policy and JSON encoder of the writer from the tap config"""
+    fast_json = config.get('output_fast_json', False)
+    if fast_json and orjson is None:
+        LOGGER.warning('output_fast_json is enabled, but orjson is not installed; '
+                       'falling back to the default JSON encoder')
+        fast_json = False
+    WRITER.flush()
+    WRITER.buffer_size = config.get('output_buffer_size', 65536)
+    WRITER.flush_interval = config.get('output_flush_interval', 5)
+    WRITER.fast_json = fast_json
+
+
+def set_record_sink(sink):
+    """
+    Writes the records to the sink instead of as RECORD messages. The state is held
+    back until the sink is removed (set_record_sink(None)) after it is closed.
+    """
+    global RECORD_SINK  # pylint: disable=global-statement
+    RECORD_SINK = sink
+    WRITER.hold_state = sink is not None
+    if sink is None:
+        WRITER.flush()
+
+
+def write_record(stream_name, record, stream_alias=None, time_extracted=None, account=None):
+    if RECORD_SINK is not None:
+        RECORD_SINK.write(stream_alias or stream_name, record, account=account)
+        return
+    WRITER.write_message(RecordMessage(stream=(stream_alias or stream_name),
+                                       record=record,
+                                       time_extracted=time_extracted))
+
+
+def write_schema(stream_name, schema, key_properties, bookmark_properties=None, stream_alias=None):
+    if isinstance(key_properties, (str, bytes)):
+        key_properties = [key_properties]
+    WRITER.write_message(SchemaMessage(stream=(stream_alias or stream_name),
+                                       schema=schema,
+                                       key_properties=key_properties,
+                                       bookmark_properties=bookmark_properties))
+
+
+def write_state(value):
+    WRITER.write_message(StateMessage(value=value))
+
+
+def discard_state():
+    WRITER.discard_state()
+
+
+def write_serialized(file):
+    WRITER.write_serialized(file)
+
+
+def flush():
+    WRITER.flush()
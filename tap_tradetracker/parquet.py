@@ -0,0 +1,235 @@
+import os
+import uuid
+import threading
+from collections import Counter, OrderedDict
+from datetime import date, datetime
+from functools import lru_cache
+
+import singer
+
+LOGGER = singer.get_logger()
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columnar export (config: output_format 'parquet'): the transformed records are
+# collected per stream, account and date partition, converted to Arrow record
+# batches and written as Parquet files
+#   <parquet_path>/<stream>/account=<account>[/<partition>=<value>]/part-<run id>-<n>.parquet
+# Report rows are partitioned by (the month or day of) their date; the other streams
+# are not partitioned. The column types are derived from the JSON schemas.
+# At most max_open_files files are open: the least recently written file is completed
+# when another one is opened, and a partition written again gets a new file (n).
+
+
+def get_json_type(schema):
+    """Returns the (non-null) JSON schema type of a schema"""
+    types = schema.get('type', 'string')
+    if isinstance(types, str):
+        return types
+    return next((typ for typ in types if typ != 'null'), 'null')
+
+
+def get_arrow_type(schema):
+    """Returns the Arrow type of the values of a JSON schema"""
+    json_type = get_json_type(schema)
+    if json_type == 'object':
+        return pyarrow.struct([pyarrow.field(name, get_arrow_type(sub_schema))
+                               for name, sub_schema in schema.get('properties', {}).items()])
+    if json_type == 'array':
+        return pyarrow.list_(get_arrow_type(schema.get('items', {})))
+    if json_type == 'integer':
+        return pyarrow.int64()
+    if json_type == 'number':
+        return pyarrow.float64()
+    if json_type == 'boolean':
+        return pyarrow.bool_()
+    if schema.get('format') == 'date-time':
+        return pyarrow.timestamp('s', tz='UTC')
+    if schema.get('format') == 'date':
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+def get_arrow_schema(schema):
+    return pyarrow.schema([pyarrow.field(name, get_arrow_type(sub_schema))
+                           for name, sub_schema in schema.get('properties', {}).items()])
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    return date.fromisoformat(value[:10])
+
+
+@lru_cache(maxsize=4096)
+def parse_datetime(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def get_converter(schema):
+    """
+    Returns a function converting the date and date-time strings of a value of the
+    schema to date/datetime objects (as expected by Arrow), or None if the values
+    do not need a conversion.
+    """
+    json_type = get_json_type(schema)
+    if json_type == 'object':
+        converters = [(name, converter) for name, converter in
+                      ((name, get_converter(sub_schema))
+                       for name, sub_schema in schema.get('properties', {}).items())
+                      if converter]
+        if not converters:
+            return None
+
+        def convert_object(value):
+            if not value:
+                return value
+            value = dict(value)
+            for name, converter in converters:
+                if value.get(name) is not None:
+                    value[name] = converter(value[name])
+            return value
+        return convert_object
+    if json_type == 'array':
+        converter = get_converter(schema.get('items', {}))
+        if converter is None:
+            return None
+        return lambda value: [converter(item) if item is not None else None for item in value]
+    if json_type == 'string' and schema.get('format') == 'date-time':
+        return parse_datetime
+    if json_type == 'string' and schema.get('format') == 'date':
+        return parse_date
+    return None
+
+
+class ParquetSink:
+    """
+    Writes records as Parquet files: the records of a partition are buffered and
+    written as a row group when row_group_size records are collected, or when
+    max_buffered_rows records of all partitions are buffered. The files are written
+    under a temporary name and renamed when the sink is closed; a failed run (or
+    close) aborts the sink, which removes them, so it leaves no partial files behind.
+    The sink is thread-safe.
+    """
+    def __init__(self, path, catalog, row_group_size=10000, partition='month', max_open_files=64,
+                 max_buffered_rows=100000):
+        if pyarrow is None:
+            raise Exception('output_format parquet requires pyarrow '
+                            '(install with `pip install tap-tradetracker[parquet]`)')
+        self.path = path
+        self.catalog = catalog
+        self.row_group_size = row_group_size
+        self.partition = partition
+        self.max_open_files = max_open_files
+        self.max_buffered_rows = max_buffered_rows
+        self.run_id = uuid.uuid4().hex[:12]
+        self.__streams = {}
+        self.__buffers = {}
+        self.__buffered_rows = 0
+        # the open writers, least recently written first
+        self.__writers = OrderedDict()
+        # the files written (temporary names), and their number per partition
+        self.__files = []
+        self.__file_counts = Counter()
+        self.__lock = threading.Lock()
+
+    def __get_stream(self, stream_name):
+        """Returns the Arrow schema and value converter of a stream"""
+        if stream_name not in self.__streams:
+            schema = self.catalog.get_stream(stream_name).schema.to_dict()
+            self.__streams[stream_name] = (get_arrow_schema(schema), get_converter(schema))
+        return self.__streams[stream_name]
+
+    def get_partition_path(self, stream_name, account, record):
+        parts = [self.path, stream_name, 'account={}'.format(account)]
+        if stream_name.endswith('_report') and record.get('date'):
+            if self.partition == 'month':
+                parts.append('month={}'.format(record['date'][:7]))
+            elif self.partition == 'day':
+                parts.append('date={}'.format(record['date'][:10]))
+        return os.path.join(*parts)
+
+    def write(self, stream_name, record, account=None):
+        partition_path = self.get_partition_path(stream_name, account, record)
+        with self.__lock:
+            key = (stream_name, partition_path)
+            buffer = self.__buffers.setdefault(key, [])
+            buffer.append(record)
+            self.__buffered_rows += 1
+            if len(buffer) >= self.row_group_size:
+                self.__flush(key)
+            elif self.__buffered_rows >= self.max_buffered_rows:
+                for buffered_key in list(self.__buffers):
+                    self.__flush(buffered_key)
+
+    def __flush(self, key):
+        stream_name, _ = key
+        records = self.__buffers.pop(key, [])
+        if not records:
+            return
+        self.__buffered_rows -= len(records)
+        arrow_schema, converter = self.__get_stream(stream_name)
+        if converter:
+            records = [converter(record) for record in records]
+        table = pyarrow.Table.from_pylist(records, schema=arrow_schema)
+        writer = self.__writers.get(key)
+        if writer is None:
+            writer = self.__open_writer(key, arrow_schema)
+        else:
+            self.__writers.move_to_end(key)
+        writer.write_table(table)
+
+    def __open_writer(self, key, arrow_schema):
+        if len(self.__writers) >= self.max_open_files:
+            _, writer = self.__writers.popitem(last=False)
+            writer.close()
+        _, partition_path = key
+        os.makedirs(partition_path, exist_ok=True)
+        file_path = os.path.join(partition_path,
+                                 'part-{}-{}.parquet.tmp'.format(self.run_id, self.__file_counts[key]))
+        self.__file_counts[key] += 1
+        self.__files.append(file_path)
+        writer = self.__writers[key] = pyarrow.parquet.ParquetWriter(file_path, arrow_schema)
+        return writer
+
+    def close(self):
+        """Writes the buffered records and completes the files; on an error, the sink is aborted"""
+        with self.__lock:
+            try:
+                for key in list(self.__buffers):
+                    self.__flush(key)
+                while self.__writers:
+                    _, writer = self.__writers.popitem(last=False)
+                    writer.close()
+                for file_path in self.__files:
+                    os.replace(file_path, file_path[:-len('.tmp')])
+            except Exception:
+                self.__abort()
+                raise
+            LOGGER.info('Parquet: wrote {} files to {}'.format(len(self.__files), self.path))
+            self.__files = []
+
+    def abort(self):
+        """Discards the buffered records and removes the incomplete files"""
+        with self.__lock:
+            self.__abort()
+
+    def __abort(self):
+        self.__buffers = {}
+        self.__buffered_rows = 0
+        for writer in self.__writers.values():
+            try:
+                writer.close()
+            except Exception as err:  # pylint: disable=broad-except
+                LOGGER.warning(f'Parquet: cannot close {writer.where}: {err!r}')
+        self.__writers = OrderedDict()
+        # files renamed by a failed close are removed too
+        for file_path in self.__files:
+            for path in (file_path, file_path[:-len('.tmp')]):
+                if os.path.exists(path):
+                    os.remove(path)
+        LOGGER.info('Parquet: removed {} incomplete files from {}'.format(len(self.__files), self.path))
+        self.__files = []
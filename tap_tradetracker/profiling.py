@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# Profiling mode (config: profile_path): the sync is profiled by
+# - cProfile, written to cpu.pstats: before Python 3.12 a profile is enabled in every
+#   thread and the profiles are merged; from 3.12 cProfile uses sys.monitoring, which
+#   has a single profiler slot and records all threads, so one profile is enabled
+# - a sampler of the stacks of all threads (every profile_interval_ms), written as
+#   collapsed stacks (stacks.collapsed, for flame graphs) with the stream and the
+#   stage of each sample as the two root frames
+# - tracemalloc snapshots after each stream (memory-<n>-<stream>.tracemalloc,
+#   config: profile_memory), loadable with tracemalloc.Snapshot.load()
+# The top hotspots are logged and written to summary.json when the sync ends.
+
+# the stage of a sample is that of its innermost frame in one of these functions
+STAGE_FUNCTIONS = {
+    'get_wsdl_client': 'wsdl_load',
+    '__call_with_retries': 'soap_call',
+    'sobject_to_record': 'convert',
+    'transform': 'transform',
+    'write_record': 'write',
+    'write_schema': 'write',
+    'write_state': 'write',
+    'write_serialized': 'write',
+    'flush': 'write',
+}
+# samples of threads waiting in these modules (idle pool threads, futures) are 'idle'
+IDLE_MODULES = ('threading.py', 'queue.py', 'thread.py', '_base.py')
+# waits of idle threads in cProfile (the top functions exclude them)
+IDLE_FUNCTIONS = ("<method 'acquire' of '_thread.lock' objects>",)
+TOP = 15
+# cProfile profiles all threads (sys.monitoring)
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class Profiler:
+    """Profiles the threads of a sync; inactive (all methods are no-ops) until started"""
+    def __init__(self):
+        self.path = None
+        self.interval = 0.005
+        self.memory = False
+        self.__profiles = []
+        self.__stacks = Counter()
+        self.__streams = {}
+        self.__snapshots = []
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__sampler = None
+
+    @property
+    def active(self):
+        return self.path is not None
+
+    def start(self, path, interval_ms=5, memory=True):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.memory = memory
+        self.__profiles = []
+        self.__stacks = Counter()
+        self.__streams = {}
+        self.__snapshots = []
+        self.__stopped.clear()
+        if memory:
+            tracemalloc.start()
+        # the sampler is started before the profile hook, so it is not profiled itself
+        self.__sampler = threading.Thread(target=self.__sample, name='profiler', daemon=True)
+        self.__sampler.start()
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(self.__profile_thread)
+        self.__enable_profile()
+        LOGGER.info(f'Profiling the sync to {path}')
+
+    def __enable_profile(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as err:
+            # another profiler holds the sys.monitoring slot (Python >= 3.12)
+            LOGGER.warning(f'cProfile is not available, profiling with samples only: {err}')
+            return
+        with self.__lock:
+            self.__profiles.append(profile)
+
+    def __profile_thread(self, frame, event, arg):  # pylint: disable=unused-argument
+        """Profile hook of new threads: replaces itself with a cProfile of the thread"""
+        sys.setprofile(None)
+        self.__enable_profile()
+
+    def set_stream(self, stream_name):
+        """Tags the samples of the current thread with a stream"""
+        if self.active:
+            self.__streams[threading.get_ident()] = stream_name
+
+    def snapshot(self, label):
+        """Takes a memory snapshot (after a stream is synced)"""
+        if self.active and self.memory:
+            file_path = os.path.join(self.path, 'memory-{}-{}.tracemalloc'.format(len(self.__snapshots) + 1, label))
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(file_path)
+            with self.__lock:
+                self.__snapshots.append((label, snapshot))
+
+    def __sample(self):
+        own_thread_id = threading.get_ident()
+        while not self.__stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == own_thread_id:
+                    continue
+                stage = None
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    if stage is None:
+                        stage = STAGE_FUNCTIONS.get(code.co_name)
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                if stage is None:
+                    stage = 'idle' if stack and stack[0].startswith(IDLE_MODULES) else 'other'
+                stream = self.__streams.get(thread_id, '-')
+                self.__stacks[';'.join([stream, stage] + stack[::-1])] += 1
+
+    def stop(self):
+        """Stops profiling, writes the profiles and logs the summary"""
+        if not self.active:
+            return
+        threading.setprofile(None)
+        # the profile of this thread (the first one) is disabled first: disabling any
+        # profile removes the profiler of the calling thread
+        with self.__lock:
+            profiles = list(self.__profiles)
+        self.__stopped.set()
+        self.__sampler.join()
+        try:
+            summary = self.__write(profiles)
+            self.__log_summary(summary)
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+            self.path = None
+
+    def __write(self, profiles):
+        for profile in profiles:
+            profile.disable()
+        stats = None
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(self.path, 'cpu.pstats'))
+
+        with open(os.path.join(self.path, 'stacks.collapsed'), 'w') as file:
+            for stack, count in sorted(self.__stacks.items()):
+                file.write('{} {}\n'.format(stack, count))
+
+        summary = {
+            'samples': self.__get_sample_shares(),
+            'functions': self.__get_top_functions(stats) if stats else [],
+        }
+        if self.memory:
+            self.snapshot('final')
+            summary['memory'] = self.__get_memory_summary()
+        with open(os.path.join(self.path, 'summary.json'), 'w') as file:
+            json.dump(summary, file, indent=2)
+        return summary
+
+    def __get_sample_shares(self):
+        """Returns the share of the (non-idle) samples per stream and stage"""
+        samples = Counter()
+        for stack, count in self.__stacks.items():
+            stream, stage = stack.split(';', 2)[:2]
+            if stage != 'idle':
+                samples[(stream, stage)] += count
+        total = sum(samples.values()) or 1
+        return [{'stream': stream, 'stage': stage, 'samples': count, 'share': round(count / total, 3)}
+                for (stream, stage), count in samples.most_common()]
+
+    @staticmethod
+    def __get_top_functions(stats):
+        """Returns the functions with the most own time"""
+        functions = sorted([item for item in stats.stats.items() if item[0][2] not in IDLE_FUNCTIONS],
+                           key=lambda item: item[1][2], reverse=True)[:TOP]
+        return [{'function': '{}:{}({})'.format(os.path.basename(filename), line, name),
+                 'calls': calls,
+                 'own_seconds': round(own_time, 3),
+                 'cumulative_seconds': round(cumulative_time, 3)}
+                for (filename, line, name), (_, calls, own_time, cumulative_time, _) in functions]
+
+    def __get_memory_summary(self):
+        """Returns the peak memory and the allocation sites which grew the most per snapshot"""
+        current, peak = tracemalloc.get_traced_memory()
+        result = {'current_mb': round(current / 2 ** 20, 1), 'peak_mb': round(peak / 2 ** 20, 1), 'streams': []}
+        previous = None
+        for label, snapshot in self.__snapshots:
+            if previous is None:
+                diffs = snapshot.statistics('lineno')
+            else:
+                diffs = snapshot.compare_to(previous, 'lineno')
+            result['streams'].append({
+                'snapshot': label,
+                'top_allocations': [{'line': str(diff.traceback[0]),
+                                     'size_kb': round(diff.size / 1024, 1),
+                                     'size_diff_kb': round(getattr(diff, 'size_diff', diff.size) / 1024, 1)}
+                                    for diff in diffs[:5]]})
+            previous = snapshot
+        return result
+
+    def __log_summary(self, summary):
+        for entry in summary['samples'][:TOP]:
+            LOGGER.info('PROFILE samples: stream={stream} stage={stage} {samples} ({share:.1%})'.format(**entry))
+        for entry in summary['functions']:
+            LOGGER.info('PROFILE function: {function} calls={calls} own={own_seconds}s '
+                        'cumulative={cumulative_seconds}s'.format(**entry))
+        if 'memory' in summary:
+            LOGGER.info('PROFILE memory: peak {peak_mb} MB'.format(**summary['memory']))
+        LOGGER.info(f'Profiles written to {self.path}')
+
+
+PROFILER = Profiler()
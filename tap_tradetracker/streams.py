@@ -10,6 +10,8 @@
 #   data_key: JSON element containing the records for the endpoint
 #   bookmark_query_field: Typically a date-time field used for filtering the query
 #   bookmark_type: Data type for bookmark, integer or datetime
+#   date_window_size: Number of days of the date windows the endpoint is requested for
+#   page_size: Number of records per request of an endpoint paged by limit/offset
 #   children: A collection of child endpoints (where the endpoint path includes the parent id)
 #   parent: On each of the children, the singular stream name for parent element
 STREAMS = {
@@ -31,6 +33,15 @@ STREAMS = {
                 'key_properties': ['ID'],
                 'replication_method': 'FULL_TABLE',
                 'parent': 'campaign_id'
+            },
+            # Reference: https://merchant.tradetracker.com/webService/index/method/getConversionTransactions
+            'conversion_transactions': {
+                'key_properties': ['ID'],
+                'replication_method': 'INCREMENTAL',
+                'replication_keys': ['registration_date'],
+                'date_window_size': 7,
+                'page_size': 500,
+                'parent': 'campaign_id'
             }
         }
     }
@@ -1,23 +1,35 @@
-import math
-from datetime import datetime,timedelta,timezone
-import humps
+import re
+import time
+import threading
+from collections import deque
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date,datetime,timedelta,timezone
 
 import singer
 from singer import metrics, metadata, Transformer, utils
 from singer.utils import strptime_to_utc, strftime
 
-from tap_tradetracker.client import TradeTrackerClient
+from tap_tradetracker import output
+from tap_tradetracker.cache import ReportCache
+from tap_tradetracker.cdc import ChangeTracker, load_index, save_index
+from tap_tradetracker.client import TradeTrackerClient, WSDL_URL, get_account_label
+from tap_tradetracker.profiling import PROFILER
 from tap_tradetracker.streams import flatten_streams, STREAMS
+from tap_tradetracker.timing import TIMINGS
 
 LOGGER = singer.get_logger()
 
+# Serializes all Singer messages (and the state changes they carry) of the
+# concurrently synced accounts, so messages are never interleaved on stdout.
+OUTPUT_LOCK = threading.RLock()
+
 
 def transform_schema(schema):
     # this hack to replace 'multipleOf' with 'multipleOfPrecision' is necessary because the
     # jsonschema validator does not support precisition of decimals (only on integers); and
     # multipleOfPrecision is somehow removed from the schema before the Transformer pre_hock
     # is called
-    import copy
     for k in schema.copy():
         if k == 'properties':
             for p in schema['properties']:
@@ -35,14 +47,16 @@ def write_schema(catalog, stream_name):
     schema = stream.schema.to_dict()
     schema = transform_schema(schema)
     try:
-        singer.write_schema(stream_name, schema, stream.key_properties)
+        with OUTPUT_LOCK:
+            output.write_schema(stream_name, schema, stream.key_properties)
     except OSError as err:
         LOGGER.error('OS Error writing schema for: {}'.format(stream_name))
         raise err
 
-def write_record(stream_name, record, time_extracted):
+def write_record(stream_name, record, time_extracted, account=None):
     try:
-        singer.messages.write_record(stream_name, record, time_extracted=time_extracted)
+        with OUTPUT_LOCK:
+            output.write_record(stream_name, record, time_extracted=time_extracted, account=account)
     except OSError as err:
         LOGGER.error('OS Error writing record for: {}'.format(stream_name))
         LOGGER.error('Stream: {}, record: {}'.format(stream_name, record))
@@ -52,55 +66,397 @@ def write_record(stream_name, record, time_extracted):
         LOGGER.error('Stream: {}, record: {}'.format(stream_name, record))
         raise err
 
-def get_bookmark(state, stream, default, bookmark_field=None, parent_id=None):
+# Bookmarks of child streams are indexed by account and parent:
+#   state['bookmarks'][stream]['<bookmark_field>(parent)'] = {account: {parent_id: value}}
+# with compact values ('YYYY-MM-DD' at midnight). Bookmarks of the former format
+#   state['bookmarks'][stream]['<bookmark_field>(parent:<parent_id>)'] = value
+# are still read, and replaced when the bookmark is written.
+# The account is a hash of the customer id and passphrase (the API has no account id).
+# The bookmarks and activity of accounts which are not configured anymore (e.g. after
+# a passphrase change) are moved to FORMER_ACCOUNTS, where they are found by parent
+# id. They are removed after a sync in which an account wrote its own value.
+FORMER_ACCOUNTS = '*'
+
+def get_bookmark_key(bookmark_field, parent_id=None):
+    if parent_id:
+        return '{}(parent:{})'.format(bookmark_field, parent_id)
+    return bookmark_field
+
+def get_parents_bookmark_key(bookmark_field):
+    return '{}(parent)'.format(bookmark_field)
+
+def get_compact_bookmark(value):
+    """Returns a bookmark value in its shortest form: the date at midnight, else the date-time in seconds"""
+    dttm = get_bookmark_datetime(value)
+    if dttm.time() == datetime.min.time():
+        return dttm.strftime('%Y-%m-%d')
+    if dttm.microsecond:
+        return strftime(dttm)
+    return dttm.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def get_bookmark(state, stream, default, bookmark_field=None, parent_id=None, account=None):
     if (state is None) or ('bookmarks' not in state):
         return default
 
     if bookmark_field is None:
         return default
 
-    if parent_id:
-        key = '{}(parent:{})'.format(bookmark_field, parent_id)
-    else:
-        key = bookmark_field
+    bookmarks = state.get('bookmarks', {}).get(stream, {})
+    if parent_id and account:
+        parents_by_account = bookmarks.get(get_parents_bookmark_key(bookmark_field), {})
+        for parents in (parents_by_account.get(account, {}), parents_by_account.get(FORMER_ACCOUNTS, {})):
+            if str(parent_id) in parents:
+                return parents[str(parent_id)]
 
-    return (
-        state
-        .get('bookmarks', {})
-        .get(stream, {})
-        .get(key, default)
-    )
+    key = get_bookmark_key(bookmark_field, parent_id)
 
-def write_bookmark(state, stream, value, bookmark_field=None, parent_id=None):
-    if parent_id:
-        key = '{}(parent:{})'.format(bookmark_field, parent_id)
+    return bookmarks.get(key, default)
+
+def write_bookmark(state, stream, value, bookmark_field=None, parent_id=None, account=None):
+    with OUTPUT_LOCK:
+        if 'bookmarks' not in state:
+            state['bookmarks'] = {}
+        if stream not in state['bookmarks']:
+            state['bookmarks'][stream] = {}
+
+        bookmarks = state['bookmarks'][stream]
+        if parent_id and account:
+            value = get_compact_bookmark(value)
+            parents_by_account = bookmarks.setdefault(get_parents_bookmark_key(bookmark_field), {})
+            parents_by_account.setdefault(account, {})[str(parent_id)] = value
+            # migration: remove the bookmark of the former format
+            bookmarks.pop(get_bookmark_key(bookmark_field, parent_id), None)
+        else:
+            bookmarks[get_bookmark_key(bookmark_field, parent_id)] = value
+        LOGGER.info('Write state for Stream: {}, Parent ID: {}, value: {}'.format(
+            stream, parent_id, value))
+        output.write_state(state)
+
+def get_account_indexes(state):
+    """Returns the values indexed by account and parent, with the parser of their values"""
+    indexes = [(bookmarks[key], get_bookmark_datetime) for bookmarks in state.get('bookmarks', {}).values()
+               for key in bookmarks if key.endswith('(parent)')]
+    if 'activity' in state:
+        indexes.append((state['activity'], date.fromisoformat))
+    return indexes
+
+def migrate_former_accounts(config, state):
+    """
+    Moves the bookmarks and activity of accounts which are not configured anymore to
+    FORMER_ACCOUNTS (the latest value of each parent); returns the number moved. The
+    state is written with the next state message.
+    """
+    passphrases = config['passphrase']
+    if not isinstance(passphrases, list):
+        passphrases = [passphrases]
+    accounts = {get_account_label(config['customer_id'], passphrase) for passphrase in passphrases}
+    moved = 0
+    with OUTPUT_LOCK:
+        for parents_by_account, parse in get_account_indexes(state):
+            for account in [account for account in parents_by_account
+                            if account not in accounts and account != FORMER_ACCOUNTS]:
+                former_parents = parents_by_account.setdefault(FORMER_ACCOUNTS, {})
+                for parent_id, value in parents_by_account.pop(account).items():
+                    if parent_id not in former_parents or parse(value) > parse(former_parents[parent_id]):
+                        former_parents[parent_id] = value
+                    moved += 1
+    if moved:
+        LOGGER.info(f'Moved {moved} bookmarks and activity entries of accounts which are not configured anymore')
+    return moved
+
+def clear_former_accounts(state):
+    """Removes the values of FORMER_ACCOUNTS of parents for which an account has its own value"""
+    cleared = 0
+    with OUTPUT_LOCK:
+        for parents_by_account, _ in get_account_indexes(state):
+            former_parents = parents_by_account.get(FORMER_ACCOUNTS)
+            if former_parents is None:
+                continue
+            account_parent_ids = set().union(*[parents for account, parents in parents_by_account.items()
+                                               if account != FORMER_ACCOUNTS])
+            for parent_id in account_parent_ids.intersection(former_parents):
+                del former_parents[parent_id]
+                cleared += 1
+            if not former_parents:
+                del parents_by_account[FORMER_ACCOUNTS]
+        if cleared:
+            LOGGER.info(f'Removed {cleared} bookmarks and activity entries of former accounts')
+            output.write_state(state)
+    return cleared
+
+def prune_bookmarks(state, parent_ids, before_datetime):
+    """
+    Removes the bookmarks (of both formats) of parents which the API does not return
+    anymore (e.g. removed campaigns) and which are older than before_datetime.
+    parent_ids are the ids (strings) of the parents by account; bookmarks of former
+    accounts and of the former format are removed if no account returns their parent.
+    Returns the number removed.
+    """
+    all_parent_ids = set().union(*parent_ids.values())
+    accounts = list(parent_ids.items()) + [(FORMER_ACCOUNTS, all_parent_ids)]
+    pruned = 0
+    with OUTPUT_LOCK:
+        for bookmarks in state.get('bookmarks', {}).values():
+            for key in list(bookmarks):
+                if key.endswith('(parent)'):
+                    for account, account_parent_ids in accounts:
+                        parents = bookmarks[key].get(account, {})
+                        for parent_id in [parent_id for parent_id, value in parents.items()
+                                          if parent_id not in account_parent_ids
+                                          and get_bookmark_datetime(value) < before_datetime]:
+                            del parents[parent_id]
+                            pruned += 1
+                        if account in bookmarks[key] and not parents:
+                            del bookmarks[key][account]
+                elif '(parent:' in key and key[key.index('(parent:') + 8:-1] not in all_parent_ids \
+                        and get_bookmark_datetime(bookmarks[key]) < before_datetime:
+                    del bookmarks[key]
+                    pruned += 1
+    return pruned
+
+# Progress of an interrupted sync (config: resume_progress), per account:
+#   state['progress'][account] = {
+#       'completed_streams': [top-level streams synced completely],
+#       'completed_parents': {child stream: [parent ids synced completely]},
+#       'current': {'stream': ..., 'parent_id': ..., 'window': start of the date window in progress}}
+# A restarted sync skips the completed streams and parents; date windows resume
+# from the bookmarks. The progress is removed when all accounts are synced.
+def get_progress(state, account):
+    return state.setdefault('progress', {}).setdefault(account, {})
+
+def is_stream_completed(state, account, stream_name):
+    with OUTPUT_LOCK:
+        return stream_name in get_progress(state, account).get('completed_streams', [])
+
+def is_parent_completed(state, account, stream_name, parent_id):
+    with OUTPUT_LOCK:
+        completed_parents = get_progress(state, account).get('completed_parents', {})
+        return parent_id in completed_parents.get(stream_name, [])
+
+def set_current_window(state, account, stream_name, parent_id, start_window):
+    """Records the date window in progress; it is written with the next state message"""
+    with OUTPUT_LOCK:
+        get_progress(state, account)['current'] = {
+            'stream': stream_name,
+            'parent_id': parent_id,
+            'window': strftime(start_window)}
+
+def write_parent_completed(state, account, stream_name, parent_id):
+    with OUTPUT_LOCK:
+        progress = get_progress(state, account)
+        progress.setdefault('completed_parents', {}).setdefault(stream_name, []).append(parent_id)
+        progress.pop('current', None)
+        output.write_state(state)
+
+def write_stream_completed(state, account, stream_name):
+    with OUTPUT_LOCK:
+        progress = get_progress(state, account)
+        progress.setdefault('completed_streams', []).append(stream_name)
+        # the parents of the child streams are not needed anymore
+        progress.pop('completed_parents', None)
+        progress.pop('current', None)
+        output.write_state(state)
+
+def write_progress_cleared(state):
+    with OUTPUT_LOCK:
+        if 'progress' in state:
+            del state['progress']
+            output.write_state(state)
+
+# Activity-aware planning of report requests (disabled by config: force_full_refresh):
+# - report days outside the period a campaign runs (its info.start_date to
+#   info.stop_date, config: skip_inactive_campaigns) are not requested, there is no
+#   data to report; their date windows are synced without records. Leads and sales
+#   of earlier clicks are still registered after the stop date, so the period ends
+#   attribution_window days after it.
+# - campaigns whose reports were empty for dormant_after_days days are dormant and
+#   only requested every dormant_poll_interval_days days, from their bookmark on.
+#   The last day with a non-empty report is kept per account and campaign:
+#     state['activity'][account][campaign_id] = 'YYYY-MM-DD'
+# The period is extended by (at least) a day on both sides for the timezone of the campaign.
+ACTIVITY_MARGIN = timedelta(days=1)
+
+def get_active_period(record):
+    """Returns the first and last day (start_date, stop_date) a campaign runs, None if unknown"""
+    info = record.get('info') or {}
+    if not info.get('start_date') and not info.get('stop_date'):
+        return None
+    start_date = date.fromisoformat(info['start_date'][:10]) if info.get('start_date') else None
+    stop_date = date.fromisoformat(info['stop_date'][:10]) if info.get('stop_date') else None
+    return start_date, stop_date
+
+def is_window_active(active_period, start_window, end_window, stop_margin=ACTIVITY_MARGIN):
+    """
+    Returns whether a report date window overlaps the active period of its campaign,
+    which ends stop_margin after the stop date
+    """
+    if active_period is None:
+        return True
+    start_date, stop_date = active_period
+    date_from, date_to = get_report_dates(start_window, end_window)
+    if start_date and date_to < start_date - ACTIVITY_MARGIN:
+        return False
+    if stop_date and date_from > stop_date + max(stop_margin, ACTIVITY_MARGIN):
+        return False
+    return True
+
+def is_empty_report(report):
+    """Returns whether all counts and amounts of a report are zero"""
+    return not any(value for value in report.values()
+                   if isinstance(value, (int, float)) and not isinstance(value, bool))
+
+def get_last_activity(state, account, parent_id):
+    with OUTPUT_LOCK:
+        activity = state.get('activity', {})
+        value = activity.get(account, {}).get(str(parent_id)) or \
+            activity.get(FORMER_ACCOUNTS, {}).get(str(parent_id))
+    return date.fromisoformat(value) if value else None
+
+def set_last_activity(state, account, parent_id, activity_date):
+    """Records the last day with data of a parent; it is written with the next state message"""
+    with OUTPUT_LOCK:
+        activity = state.setdefault('activity', {})
+        parents = activity.setdefault(account, {})
+        value = parents.get(str(parent_id))
+        if value is None:
+            # migration: the activity of a former account
+            value = activity.get(FORMER_ACCOUNTS, {}).get(str(parent_id))
+            if value is not None:
+                parents[str(parent_id)] = value
+        if value is None or date.fromisoformat(value) < activity_date:
+            parents[str(parent_id)] = activity_date.isoformat()
+
+def is_parent_dormant(config, state, account, parent_id, last_datetime):
+    """
+    Returns whether the reports of a dormant parent are not due: it had no data for
+    dormant_after_days days and was requested less than dormant_poll_interval_days ago.
+    """
+    dormant_after_days = config.get('dormant_after_days')
+    if not dormant_after_days:
+        return False
+    today = utils.now().date()
+    last_activity = get_last_activity(state, account, parent_id)
+    if last_activity is None:
+        # the activity is tracked from today on
+        set_last_activity(state, account, parent_id, today)
+        return False
+    if (today - last_activity).days <= dormant_after_days:
+        return False
+    poll_interval_days = config.get('dormant_poll_interval_days', 7)
+    return (utils.now() - get_bookmark_datetime(last_datetime)).days < poll_interval_days
+
+def prune_activity(state, parent_ids, before_date):
+    """
+    Removes the activity of parents which the API does not return anymore (parent_ids by
+    account; by no account for former accounts) and without data since before_date;
+    returns the number removed.
+    """
+    all_parent_ids = set().union(*parent_ids.values())
+    accounts = list(parent_ids.items()) + [(FORMER_ACCOUNTS, all_parent_ids)]
+    pruned = 0
+    with OUTPUT_LOCK:
+        for account, account_parent_ids in accounts:
+            parents = state.get('activity', {}).get(account)
+            if parents is None:
+                continue
+            for parent_id in [parent_id for parent_id, value in parents.items()
+                              if parent_id not in account_parent_ids
+                              and date.fromisoformat(value) < before_date]:
+                del parents[parent_id]
+                pruned += 1
+            if not parents:
+                del state['activity'][account]
+    return pruned
+
+def prune_state(config, state, parent_ids):
+    """
+    Removes the bookmarks and activity of removed parents which were not synced for
+    bookmark_retention_days days (config, default: keep all); parent_ids by account.
+    """
+    retention_days = config.get('bookmark_retention_days')
+    if not retention_days:
+        return
+    pruned = prune_bookmarks(state, parent_ids, utils.now() - timedelta(days=retention_days))
+    if pruned:
+        LOGGER.info(f'Removed {pruned} bookmarks of removed campaigns not synced for {retention_days} days')
+    pruned_activity = prune_activity(state, parent_ids, utils.now().date() - timedelta(days=retention_days))
+    if pruned_activity:
+        LOGGER.info(f'Removed the activity of {pruned_activity} removed campaigns')
+    if pruned or pruned_activity:
+        with OUTPUT_LOCK:
+            output.write_state(state)
+
+def get_decimal_places(multiple_of):
+    """Returns the number of decimal places numbers of a 'multipleOf' schema are rounded to"""
+    max_decimal_palces = len(str(multiple_of))-2
+    if max_decimal_palces < 0:
+        max_decimal_palces = 0
+    return max_decimal_palces
+
+# Records of a sync share many timestamps (e.g. the dates of the report rows of all
+# campaigns), so parsed and normalized date-times are memoized.
+# Date-times of the API ('YYYY-MM-DDTHH:MM:SS+HH:MM') are parsed by fromisoformat(), which
+# accepts more formats than strptime(); these are parsed by strptime() like before.
+API_DATETIME_FORMAT = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}[+-][0-9]{2}:[0-5][0-9]')
+
+@lru_cache(maxsize=4096)
+def normalize_datetime(value):
+    """Converts an ISO 8601 date-time with UTC offset to a UTC date-time string"""
+    if API_DATETIME_FORMAT.fullmatch(value):
+        # the format of the API: the fast path
+        dt = datetime.fromisoformat(value)
     else:
-        key = bookmark_field
-    if 'bookmarks' not in state:
-        state['bookmarks'] = {}
-    if stream not in state['bookmarks']:
-        state['bookmarks'][stream] = {}
-
-    state['bookmarks'][stream][key] = value
-    LOGGER.info('Write state for Stream: {}, Parent ID: {}, value: {}'.format(
-        stream, parent_id, value))
-    singer.write_state(state)
-
-def transform_pre_hook(data, typ, schema):
-    """A transformer hook to round numbers to their specified decimal places in the schema"""
-    if typ == 'number':
+        # other formats are parsed (or rejected) like before
+        dt = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+@lru_cache(maxsize=4096)
+def get_bookmark_datetime(value):
+    """Same as singer.utils.strptime_to_utc (memoized)"""
+    return strptime_to_utc(value)
+
+class StreamPipeline:
+    """
+    The compiled record pipeline of a stream: schema, metadata map, Transformer and
+    the per-field rounding and date-time rules are built once per sync and reused
+    for all records of the stream. A pipeline is not thread-safe.
+    """
+    def __init__(self, catalog, stream_name):
+        stream = catalog.get_stream(stream_name)
+        self.stream_name = stream_name
+        self.schema = stream.schema.to_dict()
+        self.metadata = metadata.to_map(stream.metadata)
+        # The Transformer passes the sub-schemas of self.schema to the pre_hook,
+        # so the rules are looked up by the identity of the sub-schema.
+        self.decimal_places = {}
+        self.datetime_schemas = set()
+        self.__compile(self.schema)
+        self.transformer = Transformer(pre_hook=self.pre_hook)
+
+    def __compile(self, schema):
         if schema.get('multipleOf'):
-            max_decimal_palces = len(str(schema.get('multipleOf')))-2
-            if max_decimal_palces < 0:
-                max_decimal_palces = 0
-            if isinstance(data, float):
-                return round(data, max_decimal_palces)
-    if typ == 'string' and schema.get('format') == 'date-time':
-        if data: # ignore 'None'
-            dt = datetime.strptime(data, '%Y-%m-%dT%H:%M:%S%z').astimezone(timezone.utc)
-            return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+            self.decimal_places[id(schema)] = get_decimal_places(schema['multipleOf'])
+        if schema.get('format') == 'date-time':
+            self.datetime_schemas.add(id(schema))
+        for sub_schema in schema.get('properties', {}).values():
+            self.__compile(sub_schema)
+        for sub_schema in schema.get('anyOf', []):
+            self.__compile(sub_schema)
+        if 'items' in schema:
+            self.__compile(schema['items'])
 
-    return data
+    def pre_hook(self, data, typ, schema):
+        """A transformer hook to round numbers to their decimal places and normalize date-times"""
+        if typ == 'number':
+            if isinstance(data, float) and id(schema) in self.decimal_places:
+                return round(data, self.decimal_places[id(schema)])
+        elif typ == 'string' and data and id(schema) in self.datetime_schemas:
+            return normalize_datetime(data)
+
+        return data
+
+    def transform(self, record):
+        return self.transformer.transform(record, self.schema, self.metadata)
 
 def process_records(catalog, #pylint: disable=too-many-branches
                     stream_name,
@@ -108,39 +464,278 @@ def process_records(catalog, #pylint: disable=too-many-branches
                     time_extracted,
                     bookmark_field=None,
                     max_bookmark_value=None,
-                    last_datetime=None):
-    stream = catalog.get_stream(stream_name)
-    schema = stream.schema.to_dict()
-    stream_metadata = metadata.to_map(stream.metadata)
+                    last_datetime=None,
+                    pipeline=None,
+                    change_tracker=None,
+                    account=None):
+    if pipeline is None:
+        pipeline = StreamPipeline(catalog, stream_name)
+    PROFILER.set_stream(stream_name)
+
+    # time spent transforming and writing the records of this batch
+    transform_duration = 0.0
+    write_duration = 0.0
+    max_bookmark_dttm = None
 
     with metrics.record_counter(stream_name) as counter:
         for record in records:
             # Transform record for Singer.io
-            with Transformer(pre_hook=transform_pre_hook) as transformer:
-                transformed_record = transformer.transform(
-                    record,
-                    schema,
-                    stream_metadata)
+            start = time.perf_counter()
+            transformed_record = pipeline.transform(record)
+            transform_duration += time.perf_counter() - start
 
-                # Reset max_bookmark_value to new value if higher
-                if bookmark_field and (bookmark_field in transformed_record):
-                    bookmark_date = transformed_record.get(bookmark_field)
-                    bookmark_dttm = strptime_to_utc(bookmark_date)
+            # CDC mode: skip records which did not change since the last sync
+            if change_tracker and not change_tracker.is_changed(transformed_record):
+                continue
 
+            # Reset max_bookmark_value to new value if higher
+            if bookmark_field and (bookmark_field in transformed_record):
+                bookmark_date = transformed_record.get(bookmark_field)
+                bookmark_dttm = get_bookmark_datetime(bookmark_date)
+
+                if max_bookmark_dttm is None:
                     if not max_bookmark_value:
                         max_bookmark_value = last_datetime
+                    max_bookmark_dttm = get_bookmark_datetime(max_bookmark_value)
 
-                    max_bookmark_dttm = strptime_to_utc(max_bookmark_value)
-
-                    if bookmark_dttm > max_bookmark_dttm:
-                        max_bookmark_value = strftime(bookmark_dttm)
+                if bookmark_dttm > max_bookmark_dttm:
+                    max_bookmark_dttm = bookmark_dttm
+                    max_bookmark_value = strftime(bookmark_dttm)
 
-                write_record(stream_name, transformed_record, time_extracted=time_extracted)
-                counter.increment()
+            start = time.perf_counter()
+            write_record(stream_name, transformed_record, time_extracted=time_extracted, account=account)
+            write_duration += time.perf_counter() - start
+            counter.increment()
 
+        TIMINGS.add('transform', transform_duration, records=counter.value, stream=stream_name)
+        TIMINGS.add('write', write_duration, records=counter.value, stream=stream_name)
         LOGGER.info('Stream: {}, Processed {} records'.format(stream_name, counter.value))
         return max_bookmark_value, counter.value
 
+def get_date_windows(config, stream_name, endpoint_config, last_datetime, end_datetime=None):
+    """
+    Plans the date windows [(start_window, end_window)] to request for an endpoint.
+    Report windows are date_window_size days (one day) long. Days before the attribution
+    window are final, so a backfill may request them in larger windows (config:
+    report_backfill_window_size) with aggregated rows. These windows are aligned to
+    fixed buckets of report_backfill_window_size days (see get_bucket_end), so every
+    run aggregates the same days.
+    With end_datetime, report windows are planned up to end_datetime instead of now.
+    Other endpoints with a date_window_size (conversion_transactions) are requested in
+    windows of <stream>_date_window_size days; the last <stream>_lookback_days days
+    (default: the attribution window) are requested again, as their records change.
+    """
+    attribution_window = config.get('attribution_window', 30)
+
+    # Convert to datetimes in local/ad account timezone
+    now_datetime = utils.now()
+    last_dttm = strptime_to_utc(last_datetime)
+
+    if not endpoint_config.get('date_window_size'):
+        if last_dttm < now_datetime:
+            return [(last_dttm, now_datetime)]
+        return []
+
+    # date_window_size: Number of days in each date window
+    if stream_name.endswith('_report'):
+        date_window_size = endpoint_config.get('date_window_size')
+        backfill_window_size = config.get('report_backfill_window_size', date_window_size)
+    else:
+        attribution_window = config.get('{}_lookback_days'.format(stream_name), attribution_window)
+        date_window_size = config.get('{}_date_window_size'.format(stream_name),
+                                      endpoint_config.get('date_window_size'))
+        backfill_window_size = date_window_size
+
+    # Set start window: the first day of the attribution window from midnight, so a
+    # day at its start is not requested twice (before and after the time of day of now)
+    attribution_start = (now_datetime - timedelta(days=attribution_window)) \
+        .replace(hour=0, minute=0, second=0, microsecond=0)
+    start_window = attribution_start
+    if last_dttm < start_window:
+        start_window = last_dttm
+
+    if end_datetime is None or end_datetime > now_datetime:
+        end_datetime = now_datetime
+
+    date_windows = []
+    while start_window < end_datetime:
+        # Set end window
+        if start_window < attribution_start and backfill_window_size != date_window_size:
+            end_window = min(get_bucket_end(start_window, backfill_window_size), attribution_start)
+        else:
+            end_window = start_window + timedelta(days=date_window_size)
+        if end_window > end_datetime:
+            end_window = end_datetime
+        date_windows.append((start_window, end_window))
+
+        # Increment date window
+        start_window = end_window
+
+    return date_windows
+
+def get_bucket_end(dttm, bucket_days):
+    """
+    Returns the end (midnight) of the bucket of a date-time: the days are split into
+    fixed buckets of bucket_days days, counted from 0001-01-01.
+    """
+    midnight = dttm.replace(hour=0, minute=0, second=0, microsecond=0)
+    ordinal = midnight.toordinal()
+    return midnight + timedelta(days=(ordinal // bucket_days + 1) * bucket_days - ordinal)
+
+def is_aggregated_window(stream_name, start_window, end_window):
+    """Returns whether a report date window is requested as one aggregated row (several days)"""
+    if not stream_name.endswith('_report'):
+        return False
+    date_from, date_to = get_report_dates(start_window, end_window)
+    return date_to > date_from
+
+def get_report_dates(start_window, end_window):
+    """Returns the first and last day (date_from, date_to) requested for a report date window"""
+    date_from = start_window.date()
+    date_to = (end_window - timedelta(days=1)).date()
+    if date_to < date_from:
+        date_to = date_from
+    return date_from, date_to
+
+def fetch_window(client, stream_name, start_window, end_window, parent_id=None, page_size=None, synced=False):
+    """
+    Requests the data of one date window of an endpoint from the API; synced tells
+    whether the window is before the bookmark (synced by a former sync)
+    """
+    PROFILER.set_stream(stream_name)
+    data = []
+    if stream_name == 'campaigns':
+        data = client.get_campaigns()
+    elif stream_name == 'campaign_report':
+        date_from, date_to = get_report_dates(start_window, end_window)
+        result = client.get_report_campaign(parent_id, date_from=date_from, date_to=date_to, synced=synced)
+        if result is not None:
+            data.append(result)
+    elif stream_name == 'affiliate_sites':
+        data = client.get_affiliate_sites(campaign_id=parent_id)
+    elif stream_name == 'conversion_transactions':
+        # the pages are requested while the records are processed
+        data = client.get_conversion_transactions(parent_id, start_window, end_window, page_size=page_size)
+    else:
+        raise Exception(f'Not supported stream: {stream_name}')
+    return data
+
+def plan_date_windows(config, state, account, stream_name, endpoint_config, parent_id=None, end_datetime=None,
+                      active_period=None):
+    """
+    Plans the date windows of an endpoint from its bookmark. Returns
+    [(start_window, end_window, requested)]: windows outside the active_period
+    (start_date, stop_date) of a parent are not requested; a dormant parent has no windows.
+    """
+    bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
+    last_datetime = get_bookmark(state, stream_name, config.get('start_date'), bookmark_field, parent_id, account)
+
+    date_windows = get_date_windows(config, stream_name, endpoint_config, last_datetime, end_datetime)
+
+    # Activity-aware planning of the reports of a parent (see ACTIVITY_MARGIN)
+    plan_activity = parent_id and stream_name.endswith('_report') and not config.get('force_full_refresh', False)
+    if plan_activity and date_windows and is_parent_dormant(config, state, account, parent_id, last_datetime):
+        LOGGER.info('Stream: {}, parent_id: {}, SKIP dormant parent (no data since {})'.format(
+            stream_name, parent_id, get_last_activity(state, account, parent_id)))
+        return []
+    if not plan_activity or not config.get('skip_inactive_campaigns', False):
+        active_period = None
+    # conversions of earlier clicks are registered up to the attribution window after the stop date
+    stop_margin = timedelta(days=config.get('attribution_window', 30))
+
+    return [(start_window, end_window, is_window_active(active_period, start_window, end_window, stop_margin))
+            for start_window, end_window in date_windows]
+
+def fetch_endpoint(client, config, state, stream_name, endpoint_config, parent_id=None, end_datetime=None,
+                   active_period=None):
+    """
+    Requests the data of all date windows of an endpoint (up to end_datetime, default: now).
+    Yields (start_window, end_window, data, time_extracted) per date window. Report
+    windows outside the active_period (start_date, stop_date) of the parent are not
+    requested; they are yielded without data.
+    """
+    date_windows = plan_date_windows(config, state, client.account_label, stream_name, endpoint_config, parent_id,
+                                     end_datetime, active_period)
+    page_size = config.get('{}_page_size'.format(stream_name), endpoint_config.get('page_size'))
+    # windows before the bookmark were synced by a former sync (which emitted their
+    # records), not after a state reset; unchanged reports of these windows are skipped
+    bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
+    bookmark_dttm = strptime_to_utc(get_bookmark(state, stream_name, config.get('start_date'), bookmark_field,
+                                                 parent_id, client.account_label))
+
+    for start_window, end_window, requested in date_windows:
+        if not requested:
+            yield start_window, end_window, [], utils.now()
+            continue
+        data = fetch_window(client, stream_name, start_window, end_window, parent_id, page_size,
+                            synced=start_window < bookmark_dttm)
+        # time_extracted: datetime when the data was extracted from the API
+        yield start_window, end_window, data, utils.now()
+
+def prefetch_endpoint(client, config, state, stream_name, endpoint_config, parent_id=None, active_periods=None):
+    """Like fetch_endpoint(), but requests all date windows before returning them"""
+    active_period = active_periods.get(parent_id) if active_periods else None
+    return list(fetch_endpoint(client, config, state, stream_name, endpoint_config, parent_id,
+                               active_period=active_period))
+
+def map_ordered(executor, func, items, max_in_flight):
+    """
+    Like executor.map(), but submits at most max_in_flight calls ahead of the consumer.
+    Results are yielded in the order of the items.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # calls which are not consumed (e.g. after an error) are cancelled
+        for future in pending:
+            future.cancel()
+
+def prepare_records(data,
+                    stream_name,
+                    start_window,
+                    end_window,
+                    data_key_record=None,
+                    parent=None,
+                    parent_id=None,
+                    id_field=None,
+                    ids=None,
+                    active_periods=None):
+    """
+    Yields the records of a date window one by one, with the parent id and report
+    dates added. If ids is given, the id_field value of each record is appended to it.
+    If active_periods is given, the active period of each record is added to it by id.
+    """
+    for data_record in data:
+        if data_key_record:
+            record = data_record.get(data_key_record, {})
+        else:
+            record = data_record
+
+        # Add parent id field/value
+        if parent and parent_id and parent not in record:
+            record[parent] = parent_id
+
+        if stream_name.endswith('_report'):
+            # a report over several days is one aggregated row from date to end_date; the
+            # windows are aligned to fixed buckets, so date stays the key of the report rows
+            date_from, date_to = get_report_dates(start_window, end_window)
+            record['date'] = date_from.strftime('%Y-%m-%d')
+            record['end_date'] = date_to.strftime('%Y-%m-%d')
+
+        if ids is not None:
+            ids.append(record.get(id_field))
+        if active_periods is not None:
+            active_periods[record.get(id_field)] = get_active_period(record)
+
+        # record keys are already snake_case (see client.sobject_to_record)
+        yield record
+
 # Sync a specific parent or child endpoint.
 def sync_endpoint(
         client,
@@ -152,178 +747,210 @@ def sync_endpoint(
         sync_streams,
         selected_streams,
         timezone_desc=None,
-        parent_id=None):
+        parent_id=None,
+        fetched_windows=None,
+        pipelines=None,
+        change_index=None,
+        active_period=None,
+        executor=None):
 
     # endpoint_config variables
     bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
+    date_window_size = endpoint_config.get('date_window_size')
     data_key_record = endpoint_config.get('data_key_record')
     id_fields = endpoint_config.get('key_properties')
     parent = endpoint_config.get('parent')
-    date_window_size = endpoint_config.get('date_window_size')
+    children = endpoint_config.get('children')
 
     # tap config variabless
     start_date = config.get('start_date')
-    attribution_window = config.get('attribution_window', 30)
+    max_campaign_workers = config.get('max_campaign_workers', 1)
+    # account of the progress checkpoints (None: no checkpoints)
+    account = client.account_label if config.get('resume_progress', True) else None
 
-    last_datetime = get_bookmark(state, stream_name, start_date, bookmark_field, parent_id)
+    last_datetime = get_bookmark(state, stream_name, start_date, bookmark_field, parent_id, client.account_label)
     max_bookmark_value = last_datetime
 
-    # Convert to datetimes in local/ad account timezone
-    now_datetime = utils.now()
-    last_dttm = strptime_to_utc(last_datetime)
+    # Set parent_id field for the children
+    i = 0
+    for id_field in id_fields:
+        if i == 0:
+            parent_id_field = id_field
+        if id_field == 'id':
+            parent_id_field = id_field
+        i = i + 1
 
-    if stream_name.endswith('_report'):
-        # date_window_size: Number of days in each date window
-        # Set start window
-        start_window = now_datetime - timedelta(days=attribution_window)
-        if last_dttm < start_window:
-            start_window = last_dttm
-        # Set end window
-        end_window = start_window + timedelta(days=date_window_size)
+    # CDC mode: FULL_TABLE streams only emit records changed since the last sync
+    change_tracker = None
+    if change_index is not None and endpoint_config.get('replication_method') == 'FULL_TABLE':
+        scope = 'parent:{}'.format(parent_id) if parent_id else 'account:{}'.format(client.account_key[:16])
+        change_tracker = ChangeTracker(change_index, stream_name, scope, id_fields)
 
-    else:
-        start_window = last_dttm
-        end_window = now_datetime
-        diff_sec = (end_window - start_window).seconds
-        date_window_size = math.ceil(diff_sec / (3600 * 24)) # round-up difference to days
+    # The data of the date windows can be requested up front (see the concurrent
+    # child requests below); otherwise it is requested window by window.
+    if fetched_windows is None:
+        fetched_windows = fetch_endpoint(client, config, state, stream_name, endpoint_config, parent_id,
+                                         active_period=active_period)
+    # the last day with data of a parent is tracked for the activity-aware planning
+    track_activity = bool(parent_id and stream_name.endswith('_report') and config.get('dormant_after_days'))
 
     total_records = 0
 
-    while start_window < now_datetime:
+    for start_window, end_window, data, time_extracted in fetched_windows:
         LOGGER.info('START Sync for Stream: {}{}'.format(
             stream_name,
             ', Date window from: {} to {}'.format(start_window.date(), end_window.date()) \
-                if stream_name.endswith('_report') else ''))
-
-        data = []
-        if stream_name == 'campaigns':
-            data = client.get_campaigns()
-        elif stream_name == 'campaign_report':
-            date_from = start_window.date()
-            date_to = (end_window - timedelta(days=1)).date()
-            if date_to < date_from:
-                date_to = date_from
-            result = client.get_report_campaign(parent_id, date_from=date_from, date_to=date_to)
-            data.append(result)
-        elif stream_name == 'affiliate_sites':
-            data = client.get_affiliate_sites(campaign_id=parent_id)
-        else:
-            raise Exception(f'Not supported stream: {stream_name}')
+                if date_window_size else ''))
+        if account and parent_id:
+            set_current_window(state, account, stream_name, parent_id, start_window)
 
-        # time_extracted: datetime when the data was extracted from the API
-        time_extracted = utils.now()
-        if not data or data is None or data == []:
-            LOGGER.info('No data results returned')
-            total_records = 0
-        else:
-            # Process records and get the max_bookmark_value and record_count
-            if stream_name in sync_streams:
+        # Process records and get the max_bookmark_value and record_count
+        if stream_name in sync_streams:
+            # The records are streamed from the API response through the transformation
+            # to the output; only the ids of parent records are kept for the children.
+            parent_ids = [] if children else None
+            active_periods = {} if children else None
+            if track_activity and any(not is_empty_report(report) for report in data):
+                set_last_activity(state, client.account_label, parent_id,
+                                  get_report_dates(start_window, end_window)[1])
+            records = prepare_records(data,
+                                      stream_name=stream_name,
+                                      start_window=start_window,
+                                      end_window=end_window,
+                                      data_key_record=data_key_record,
+                                      parent=parent,
+                                      parent_id=parent_id,
+                                      id_field=parent_id_field,
+                                      ids=parent_ids,
+                                      active_periods=active_periods)
+
+            max_bookmark_value, record_count = process_records(catalog=catalog,
+                            stream_name=stream_name,
+                            records=records,
+                            time_extracted=time_extracted,
+                            bookmark_field=bookmark_field,
+                            max_bookmark_value=max_bookmark_value,
+                            last_datetime=last_datetime,
+                            pipeline=pipelines.get(stream_name) if pipelines else None,
+                            change_tracker=change_tracker,
+                            account=client.account_label)
+            total_records = total_records + record_count
+
+            # Unchanged reports are not emitted (report_changes_only), but their
+            # date window is synced nonetheless: move the bookmark to the window.
+            # The same holds for date windows without records of other endpoints.
+            if record_count == 0 and bookmark_field and date_window_size:
+                window_dttm = start_window.replace(hour=0, minute=0, second=0, microsecond=0)
+                if window_dttm > strptime_to_utc(max_bookmark_value):
+                    max_bookmark_value = strftime(window_dttm)
+            # Aggregated report windows cover final days: the bookmark moves past the
+            # window, so they are not requested again (as a different aggregate)
+            if bookmark_field and is_aggregated_window(stream_name, start_window, end_window):
+                if end_window > strptime_to_utc(max_bookmark_value):
+                    max_bookmark_value = strftime(end_window)
 
-                # Transform data
-                transformed_data = [] # initialize the record list
+            if record_count == 0:
+                LOGGER.info('No data results returned')
+            else:
+                LOGGER.info('Stream {}, batch processed {} records'.format(
+                    stream_name, record_count))
 
-                for data_record in data:
-                    if data_key_record:
-                        record = data_record.get(data_key_record, {})
-                    else:
-                        record = data_record
+            # Loop thru parent batch records for each children objects (if should stream)
+            if children and parent_ids:
+                for child_stream_name, child_endpoint_config in children.items():
+                    if child_stream_name in sync_streams:
+                        LOGGER.info('START Syncing: {}'.format(child_stream_name))
+                        write_schema(catalog, child_stream_name)
 
-                    # Add parent id field/value
-                    if parent and parent_id and parent not in record:
-                        record[parent] = parent_id
+                        # Skip the parents synced completely by an interrupted sync
+                        child_parent_ids = parent_ids
+                        if account:
+                            child_parent_ids = [
+                                child_parent_id for child_parent_id in parent_ids
+                                if not is_parent_completed(state, account, child_stream_name, child_parent_id)]
+                            if len(child_parent_ids) < len(parent_ids):
+                                LOGGER.info('Stream: {}, resume after {} completed parents'.format(
+                                    child_stream_name, len(parent_ids) - len(child_parent_ids)))
 
-                    if stream_name.endswith('_report'):
-                        if date_window_size == 1:
-                            record['date'] = start_window.strftime('%Y-%m-%d')
+                        # Request the child data of up to max_campaign_workers parents
+                        # concurrently; records and bookmarks are still written in
+                        # the order of the parent records. Paged endpoints are requested
+                        # page by page while their records are processed (bounded memory).
+                        if executor and not child_endpoint_config.get('page_size'):
+                            child_fetched_windows = map_ordered(
+                                executor,
+                                partial(prefetch_endpoint, client, config, state,
+                                        child_stream_name, child_endpoint_config,
+                                        active_periods=active_periods),
+                                child_parent_ids,
+                                max_campaign_workers)
                         else:
-                            record['start_date'] = start_window.strftime('%Y-%m-%d')
-                            record['end_date'] = (end_window - timedelta(days=1)).strftime('%Y-%m-%d')
-
-                    # transform record (remove inconsistent use of CamelCase)
-                    try:
-                        transformed_record = humps.decamelize(record)
-                    except Exception as err:
-                        LOGGER.error('{}'.format(err))
-                        LOGGER.error('error record: {}'.format(record))
-                        raise Exception(err)
-
-                    transformed_data.append(transformed_record)
-
-                # LOGGER.info('transformed_data = {}'.format(transformed_data)) # COMMENT OUT
-                if not transformed_data or transformed_data is None:
-                    LOGGER.info('No transformed data for data = {}'.format(data))
-                    total_records = 0
-                    #break # No transformed_data results
-                else:
-                    max_bookmark_value, record_count = process_records(catalog=catalog,
-                                    stream_name=stream_name,
-                                    records=transformed_data,
-                                    time_extracted=time_extracted,
-                                    bookmark_field=bookmark_field,
-                                    max_bookmark_value=max_bookmark_value,
-                                    last_datetime=last_datetime)
-                    LOGGER.info('Stream {}, batch processed {} records'.format(
-                        stream_name, record_count))
-
-                    # Loop thru parent batch records for each children objects (if should stream)
-                    children = endpoint_config.get('children')
-                    if children:
-                        for child_stream_name, child_endpoint_config in children.items():
-                            if child_stream_name in sync_streams:
-                                LOGGER.info('START Syncing: {}'.format(child_stream_name))
-                                write_schema(catalog, child_stream_name)
-
-                                # For each parent record
-                                for record in data:
-                                    i = 0
-                                    # Set parent_id
-                                    for id_field in id_fields:
-                                        if i == 0:
-                                            parent_id_field = id_field
-                                        if id_field == 'id':
-                                            parent_id_field = id_field
-                                        i = i + 1
-                                    parent_id = record.get(parent_id_field)
-
-                                    # sync_endpoint for child
-                                    LOGGER.info(
-                                        'START Sync for Stream: {}, parent_stream: {}, parent_id: {}'\
-                                            .format(child_stream_name, stream_name, parent_id))
-
-                                    child_total_records = sync_endpoint(
-                                        client=client,
-                                        config=config,
-                                        catalog=catalog,
-                                        state=state,
-                                        stream_name=child_stream_name,
-                                        endpoint_config=child_endpoint_config,
-                                        sync_streams=sync_streams,
-                                        selected_streams=selected_streams,
-                                        timezone_desc=timezone_desc,
-                                        parent_id=parent_id)
-
-                                    LOGGER.info(
-                                        'FINISHED Sync for Stream: {}, parent_id: {}, total_records: {}'\
-                                            .format(child_stream_name, parent_id, child_total_records))
-                                    # End transformed data record loop
-                                # End if child in sync_streams
-                            # End child streams for parent
-                        # End if children
+                            child_fetched_windows = (None for _ in child_parent_ids)
+
+                        try:
+                            # For each parent record
+                            for child_parent_id, fetched in zip(child_parent_ids, child_fetched_windows):
+                                # sync_endpoint for child
+                                LOGGER.info(
+                                    'START Sync for Stream: {}, parent_stream: {}, parent_id: {}'\
+                                        .format(child_stream_name, stream_name, child_parent_id))
+
+                                child_total_records = sync_endpoint(
+                                    client=client,
+                                    config=config,
+                                    catalog=catalog,
+                                    state=state,
+                                    stream_name=child_stream_name,
+                                    endpoint_config=child_endpoint_config,
+                                    sync_streams=sync_streams,
+                                    selected_streams=selected_streams,
+                                    timezone_desc=timezone_desc,
+                                    parent_id=child_parent_id,
+                                    fetched_windows=fetched,
+                                    pipelines=pipelines,
+                                    change_index=change_index,
+                                    active_period=active_periods.get(child_parent_id),
+                                    executor=executor)
+
+                                if account:
+                                    write_parent_completed(state, account, child_stream_name, child_parent_id)
+                                LOGGER.info(
+                                    'FINISHED Sync for Stream: {}, parent_id: {}, total_records: {}'\
+                                        .format(child_stream_name, child_parent_id, child_total_records))
+                                # End parent record loop
+                        finally:
+                            child_fetched_windows.close()
+                        PROFILER.snapshot(child_stream_name)
+                        # End if child in sync_streams
+                    # End child streams for parent
+                # End if children
 
         # Update the state with the max_bookmark_value for the stream date window
         # Snapchat Ads API does not allow page/batch sorting; bookmark written for date window
         if bookmark_field and stream_name in selected_streams:
-            write_bookmark(state, stream_name, max_bookmark_value, bookmark_field, parent_id)
-
-        # Increment date window and sum endpoint_total
-        start_window = end_window
-        next_end_window = end_window + timedelta(days=date_window_size)
-        if next_end_window > now_datetime:
-            end_window = now_datetime
-        else:
-            end_window = next_end_window
+            write_bookmark(state, stream_name, max_bookmark_value, bookmark_field, parent_id, client.account_label)
         # End date window
 
+    if change_tracker and stream_name in sync_streams:
+        if config.get('cdc_tombstones', False):
+            deleted_at = utils.now().isoformat(timespec='seconds')
+            tombstones = []
+            for key in change_tracker.get_deleted_keys():
+                tombstone = change_tracker.get_tombstone(key, deleted_at)
+                if parent and parent_id:
+                    tombstone[parent] = parent_id
+                tombstones.append(tombstone)
+            if tombstones:
+                LOGGER.info('Stream: {}, {} deleted records'.format(stream_name, len(tombstones)))
+                process_records(catalog=catalog,
+                                stream_name=stream_name,
+                                records=tombstones,
+                                time_extracted=utils.now(),
+                                pipeline=pipelines.get(stream_name) if pipelines else None,
+                                account=client.account_label)
+        with OUTPUT_LOCK:
+            change_tracker.commit()
+
     return total_records
 
 # Currently syncing sets the stream currently being delivered in the state.
@@ -331,25 +958,95 @@ def sync_endpoint(
 #  the starting point to continue from.
 # Reference: https://github.com/singer-io/singer-python/blob/master/singer/bookmarks.py#L41-L46
 def update_currently_syncing(state, stream_name):
-    if (stream_name is None) and ('currently_syncing' in state):
-        del state['currently_syncing']
-    else:
-        singer.set_currently_syncing(state, stream_name)
-    singer.write_state(state)
+    with OUTPUT_LOCK:
+        if (stream_name is None) and ('currently_syncing' in state):
+            del state['currently_syncing']
+        else:
+            singer.set_currently_syncing(state, stream_name)
+        output.write_state(state)
 
 def sync(config, catalog, state):
-    # Get selected_streams from catalog, based on state last_stream
-    #   last_stream = Previous currently synced stream, if the load was interrupted
-    last_stream = singer.get_currently_syncing(state)
-    LOGGER.info('last/currently syncing stream: {}'.format(last_stream))
-    selected_streams = []
-    for stream in catalog.get_selected_streams(state):
-        selected_streams.append(stream.stream)
-    LOGGER.info('selected_streams: {}'.format(selected_streams))
-    if not selected_streams or selected_streams == []:
-        return
+    output.configure(config)
+    TIMINGS.reset()
+    report_cache = None
+    change_index = None
+    cdc_index_path = config.get('cdc_index_path')
+    record_sink = None
+    completed = False
+    # the setup is in the try, so a failed setup stops the profiler too
+    try:
+        # Profiling mode: CPU profiles, stack samples and memory snapshots of the sync
+        if config.get('profile_path'):
+            PROFILER.start(config['profile_path'],
+                           interval_ms=config.get('profile_interval_ms', 5),
+                           memory=config.get('profile_memory', True))
+        if config.get('report_cache_path'):
+            report_cache = ReportCache(config['report_cache_path'])
+            report_cache.evict(utils.now().date() - timedelta(days=config.get('report_cache_max_age_days', 400)))
+            # reports cached by a failed sync are not committed
+            report_cache.discard_pending()
+        # CDC mode: the fingerprint index is kept in a sidecar file, out of the STATE messages
+        if config.get('cdc_mode', False):
+            if not cdc_index_path:
+                raise Exception('cdc_mode requires cdc_index_path (the file of the fingerprint index)')
+            # the CDC scope of affiliate sites is a campaign: a deduplicated site which moves to another
+            # campaign would be missing from the scope of its former campaign, and deleted by a tombstone
+            if config.get('cdc_tombstones', False) and config.get('affiliate_sites_dedupe', False):
+                raise Exception('cdc_tombstones cannot be combined with affiliate_sites_dedupe')
+            change_index = load_index(cdc_index_path)
+            # migration: the index was kept in the state before
+            if 'cdc' in state:
+                if not change_index:
+                    change_index = state['cdc']
+                del state['cdc']
+        # Parquet mode: the records are written as Parquet files instead of RECORD messages
+        if config.get('output_format', 'singer') == 'parquet':
+            from tap_tradetracker.parquet import ParquetSink
+            record_sink = ParquetSink(config['parquet_path'],
+                                      catalog,
+                                      row_group_size=config.get('parquet_row_group_size', 10000),
+                                      partition=config.get('parquet_partition', 'month'),
+                                      max_open_files=config.get('parquet_max_open_files', 64),
+                                      max_buffered_rows=config.get('parquet_max_buffered_rows', 100000))
+            output.set_record_sink(record_sink)
+        # the bookmarks of accounts which are not configured anymore are found by parent id
+        migrate_former_accounts(config, state)
+        # Backfill mode: the final report days are synced by a pool of processes first
+        if config.get('backfill_workers') and \
+                'campaign_report' in [stream.stream for stream in catalog.get_selected_streams(state)]:
+            from tap_tradetracker.backfill import run_backfill
+            run_backfill(config, catalog, state)
+        sync_accounts(config, catalog, state, report_cache, change_index)
+        if record_sink:
+            # the state is written once the files are complete
+            record_sink.close()
+        completed = True
+    finally:
+        if record_sink:
+            if not completed:
+                # the files of a failed run are removed, and the state of their records is not written
+                record_sink.abort()
+                output.discard_state()
+            output.set_record_sink(None)
+        output.flush()
+        if report_cache:
+            if completed:
+                # the records of the pending reports are written
+                report_cache.commit()
+            else:
+                report_cache.discard_pending()
+            report_cache.close()
+        # the timings are reported for failed runs too
+        TIMINGS.log_summary()
+        if config.get('metrics_summary_path'):
+            TIMINGS.write_summary(config['metrics_summary_path'])
+        PROFILER.stop()
+    # saved after all records are written, so a failed run emits them again
+    if change_index is not None:
+        save_index(cdc_index_path, change_index)
 
-    # Get the streams to sync (based on dependencies)
+def get_sync_streams(selected_streams):
+    """Returns the streams to sync: the selected streams and their parents"""
     sync_streams = []
     flat_streams = flatten_streams()
     # Loop thru all streams
@@ -364,44 +1061,150 @@ def sync(config, catalog, state):
                 sync_streams.append(stream_name)
             if parent_stream and parent_stream not in sync_streams:
                 sync_streams.append(parent_stream)
+    return sync_streams
+
+def sync_accounts(config, catalog, state, report_cache=None, change_index=None):
+    # Get selected_streams from catalog, based on state last_stream
+    #   last_stream = Previous currently synced stream, if the load was interrupted
+    last_stream = singer.get_currently_syncing(state)
+    LOGGER.info('last/currently syncing stream: {}'.format(last_stream))
+    selected_streams = []
+    for stream in catalog.get_selected_streams(state):
+        selected_streams.append(stream.stream)
+    LOGGER.info('selected_streams: {}'.format(selected_streams))
+    if not selected_streams or selected_streams == []:
+        return
+
+    sync_streams = get_sync_streams(selected_streams)
     LOGGER.info('Sync Streams: {}'.format(sync_streams))
 
-    i = 0
     passphrases = config['passphrase']
     if not isinstance(passphrases, list):
         passphrases = [passphrases]
-    for passphrase in passphrases:
-        i += 1
-        LOGGER.info(f'Start sync. country no. {i}/{len(passphrases)}')
-        LOGGER.info('Initializing TradeTrackerClient client - Loading WSDL')
-        with TradeTrackerClient(customer_id=config['customer_id'],
-                                passphrase=passphrase,
-                                sandbox=config.get('sandbox', False),
-                                locale=config.get('locale'),
-                                demo=config.get('demo', False)) as client:
-
-            LOGGER.info('Authenticate against API')
-            client.authenticate()
-
-            # Loop through selected_streams
-            # Loop through endpoints in selected_streams
-            for stream_name, endpoint_config in STREAMS.items():
-                if stream_name in sync_streams:
-                    LOGGER.info('START Syncing: {}'.format(stream_name))
-                    write_schema(catalog, stream_name)
-                    update_currently_syncing(state, stream_name)
-
-                    total_records = sync_endpoint(
-                        client=client,
-                        config=config,
-                        catalog=catalog,
-                        state=state,
-                        stream_name=stream_name,
-                        endpoint_config=endpoint_config,
-                        sync_streams=sync_streams,
-                        selected_streams=selected_streams)
-
-                    update_currently_syncing(state, None)
-                    LOGGER.info('FINISHED Syncing: {}, total_records: {}'.format(
-                        stream_name,
-                        total_records))
+
+    # Accounts (passphrases) are synced in parallel by a pool of threads; all accounts
+    # share the state document, their bookmarks are keyed by campaign.
+    max_account_workers = config.get('max_account_workers', 1)
+    LOGGER.info(f'Sync {len(passphrases)} countries with {max_account_workers} worker(s)')
+    with ThreadPoolExecutor(max_workers=max_account_workers) as executor:
+        futures = [executor.submit(sync_account,
+                                   config=config,
+                                   catalog=catalog,
+                                   state=state,
+                                   passphrase=passphrase,
+                                   account_no=i,
+                                   account_count=len(passphrases),
+                                   sync_streams=sync_streams,
+                                   selected_streams=selected_streams,
+                                   report_cache=report_cache,
+                                   change_index=change_index)
+                   for i, passphrase in enumerate(passphrases, start=1)]
+        # ids of the campaigns of each account (for bookmark_retention_days)
+        parent_ids = dict(future.result() for future in futures)
+
+    prune_state(config, state, parent_ids)
+    clear_former_accounts(state)
+    # all accounts are synced: a new sync starts from the beginning again
+    write_progress_cleared(state)
+
+def get_client(config, passphrase, report_cache=None):
+    """Returns the client of the account with the passphrase, configured by the tap config"""
+    return TradeTrackerClient(customer_id=config['customer_id'],
+                              passphrase=passphrase,
+                              sandbox=config.get('sandbox', False),
+                              locale=config.get('locale'),
+                              demo=config.get('demo', False),
+                              wsdl=config.get('wsdl', WSDL_URL),
+                              wsdl_cache_dir=config.get('wsdl_cache_dir'),
+                              wsdl_cache_days=config.get('wsdl_cache_days', 1),
+                              timeout=config.get('request_timeout', 90),
+                              max_retries=config.get('max_retries', 5),
+                              backoff_factor=config.get('retry_backoff_factor', 2),
+                              max_requests_per_second=config.get('max_requests_per_second'),
+                              keep_alive=config.get('http_keep_alive', True),
+                              pool_size=config.get('http_pool_size', max(config.get('max_campaign_workers', 1), 4)),
+                              accept_gzip=config.get('http_gzip', False),
+                              report_cache=report_cache,
+                              report_final_after_days=config.get('report_final_after_days'),
+                              report_changes_only=config.get('report_changes_only', False),
+                              dedupe_affiliate_sites=config.get('affiliate_sites_dedupe', False))
+
+def sync_account(config,
+                 catalog,
+                 state,
+                 passphrase,
+                 account_no,
+                 account_count,
+                 sync_streams,
+                 selected_streams,
+                 report_cache=None,
+                 change_index=None):
+    LOGGER.info(f'Start sync. country no. {account_no}/{account_count}')
+    LOGGER.info('Initializing TradeTrackerClient client - Loading WSDL')
+    with get_client(config, passphrase, report_cache) as client:
+
+        TIMINGS.set_account(client.account_label)
+        LOGGER.info('Authenticate against API')
+        client.authenticate()
+
+        # Record pipelines of this account (Transformers are not thread-safe)
+        pipelines = {stream_name: StreamPipeline(catalog, stream_name)
+                     for stream_name in sync_streams}
+
+        # account of the progress checkpoints (None: no checkpoints)
+        account = client.account_label if config.get('resume_progress', True) else None
+
+        # Workers requesting the child streams of max_campaign_workers campaigns concurrently;
+        # shared by all streams of the account, as each worker thread authenticates its own session
+        max_campaign_workers = config.get('max_campaign_workers', 1)
+        executor = ThreadPoolExecutor(max_workers=max_campaign_workers) if max_campaign_workers > 1 else None
+        try:
+            sync_account_streams(config, catalog, state, client, account, sync_streams, selected_streams,
+                                 pipelines, change_index, executor)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+        for pipeline in pipelines.values():
+            pipeline.transformer.log_warning()
+
+        # the campaigns the API still returns keep their bookmarks (see prune_state)
+        campaign_ids = set()
+        if config.get('bookmark_retention_days'):
+            campaign_ids = {str(campaign['ID']) for campaign in client.get_campaigns()}
+        return client.account_label, campaign_ids
+
+def sync_account_streams(config, catalog, state, client, account, sync_streams, selected_streams, pipelines,
+                         change_index=None, executor=None):
+    """Syncs the selected top-level streams (and their children) of an account"""
+    # Loop through selected_streams
+    # Loop through endpoints in selected_streams
+    for stream_name, endpoint_config in STREAMS.items():
+        if stream_name in sync_streams:
+            if account and is_stream_completed(state, account, stream_name):
+                LOGGER.info('SKIP Syncing: {}, completed by an interrupted sync'.format(stream_name))
+                continue
+            LOGGER.info('START Syncing: {}'.format(stream_name))
+            write_schema(catalog, stream_name)
+            update_currently_syncing(state, stream_name)
+
+            total_records = sync_endpoint(
+                client=client,
+                config=config,
+                catalog=catalog,
+                state=state,
+                stream_name=stream_name,
+                endpoint_config=endpoint_config,
+                sync_streams=sync_streams,
+                selected_streams=selected_streams,
+                pipelines=pipelines,
+                change_index=change_index,
+                executor=executor)
+
+            update_currently_syncing(state, None)
+            if account:
+                write_stream_completed(state, account, stream_name)
+            PROFILER.snapshot(stream_name)
+            LOGGER.info('FINISHED Syncing: {}, total_records: {}'.format(
+                stream_name,
+                total_records))
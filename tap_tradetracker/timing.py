@@ -0,0 +1,115 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# upper bounds (in milliseconds) of the latency histogram buckets
+HISTOGRAM_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class StageTimer:
+    """Aggregated timings of one stage (e.g. a SOAP method) for one stream and account"""
+    def __init__(self):
+        self.count = 0
+        self.records = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+    def add(self, seconds, records=0):
+        self.count += 1
+        self.records += records
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        milliseconds = seconds * 1000
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS_MS) and milliseconds > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def get_histogram(self):
+        """Returns the non-empty histogram buckets, labelled by their upper bound"""
+        labels = [f'<={bound}' for bound in HISTOGRAM_BOUNDS_MS] + [f'>{HISTOGRAM_BOUNDS_MS[-1]}']
+        return {label: count for label, count in zip(labels, self.histogram) if count}
+
+    def to_dict(self):
+        result = {
+            'count': self.count,
+            'total_seconds': round(self.total, 6),
+            'mean_seconds': round(self.total / self.count, 6) if self.count else 0,
+            'min_seconds': round(self.min or 0, 6),
+            'max_seconds': round(self.max, 6),
+            'histogram_ms': self.get_histogram()
+        }
+        if self.records:
+            result['records'] = self.records
+            result['records_per_second'] = round(self.records / self.total, 1) if self.total else None
+        return result
+
+
+class Timings:
+    """Thread-safe collection of StageTimers by (stage, stream, account)"""
+    def __init__(self):
+        self.__timers = {}
+        self.__lock = threading.Lock()
+        self.__context = threading.local()
+
+    def set_account(self, account):
+        """Sets the account the timings of the current thread are tagged with"""
+        self.__context.account = account
+
+    def get_account(self):
+        return getattr(self.__context, 'account', None)
+
+    def add(self, stage, seconds, records=0, stream=None, account=None):
+        if account is None:
+            account = self.get_account()
+        key = (stage, stream, account)
+        with self.__lock:
+            timer = self.__timers.get(key)
+            if timer is None:
+                timer = self.__timers[key] = StageTimer()
+            timer.add(seconds, records)
+
+    @contextmanager
+    def timed(self, stage, stream=None, account=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, stream=stream, account=account)
+
+    def summary(self):
+        with self.__lock:
+            items = sorted(self.__timers.items(), key=lambda item: [str(part) for part in item[0]])
+            return [dict(stage=stage, stream=stream, account=account, **timer.to_dict())
+                    for (stage, stream, account), timer in items]
+
+    def reset(self):
+        with self.__lock:
+            self.__timers = {}
+
+    def log_summary(self):
+        """Logs the aggregated timings as Singer METRIC (timer) lines"""
+        for entry in self.summary():
+            tags = {key: value for key, value in entry.items()
+                    if key not in ('total_seconds',) and value is not None}
+            LOGGER.info('METRIC: %s', json.dumps({'type': 'timer',
+                                                  'metric': 'stage_duration',
+                                                  'value': entry['total_seconds'],
+                                                  'tags': tags}))
+
+    def write_summary(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+
+TIMINGS = Timings()
@@ -0,0 +1,104 @@
+import io
+import gzip
+import queue
+import threading
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.response import addinfourl
+
+from suds.transport.https import HttpAuthenticated
+
+import singer
+
+LOGGER = singer.get_logger()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent (keep-alive) HTTP connections per host.
+    Up to maxsize idle connections are kept per host; more connections can be
+    open at the same time, the surplus is closed when returned to the pool.
+    """
+    def __init__(self, maxsize=4, timeout=90):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def __queue(self, scheme, netloc):
+        with self.__lock:
+            return self.__idle.setdefault((scheme, netloc), queue.LifoQueue(self.maxsize))
+
+    def get(self, scheme, netloc):
+        try:
+            return self.__queue(scheme, netloc).get_nowait()
+        except queue.Empty:
+            connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+            return connection_class(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, connection):
+        try:
+            self.__queue(scheme, netloc).put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            while not connections.empty():
+                connections.get_nowait().close()
+
+
+class PooledHttpTransport(HttpAuthenticated):
+    """
+    suds transport which sends the requests over the persistent connections of a
+    ConnectionPool instead of opening a new connection per request with urllib.
+    Cookies (the session) are kept per transport, the pool can be shared by the
+    transports of several suds clients. With accept_gzip, compressed responses are accepted.
+    """
+    def __init__(self, pool=None, accept_gzip=False, **kwargs):
+        HttpAuthenticated.__init__(self, **kwargs)
+        self.pool = pool or ConnectionPool()
+        self.accept_gzip = accept_gzip
+
+    def u2open(self, u2request):
+        url = urlsplit(u2request.full_url)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        headers = dict(u2request.header_items())
+        if self.accept_gzip:
+            headers['Accept-Encoding'] = 'gzip'
+
+        # an idle keep-alive connection may have been closed by the server meanwhile,
+        # so a failed request on a pooled connection is sent once more on a new one
+        for attempt in range(2):
+            connection = self.pool.get(url.scheme, url.netloc)
+            try:
+                connection.request(u2request.get_method(), path, body=u2request.data, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (HTTPException, ConnectionError):
+                connection.close()
+                if attempt:
+                    raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(url.scheme, url.netloc, connection)
+
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if response.status >= 400:
+            raise HTTPError(u2request.full_url, response.status, response.reason,
+                            response.headers, io.BytesIO(body))
+        return addinfourl(io.BytesIO(body), response.headers, u2request.full_url, response.status)
+
+    def __deepcopy__(self, memo={}):  # pylint: disable=dangerous-default-value
+        clone = HttpAuthenticated.__deepcopy__(self, memo)
+        clone.pool = self.pool
+        clone.accept_gzip = self.accept_gzip
+        return clone
@@ -0,0 +1,46 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from tap_tradetracker.backfill import plan_backfill
+from tap_tradetracker.sync import get_bucket_end
+
+ACCOUNT = '60d390029edfc3f7'
+NOW = datetime(2026, 10, 18, 12, 34, tzinfo=timezone.utc)
+CONFIG = {'start_date': '2026-08-19T00:00:00Z', 'attribution_window': 3, 'report_backfill_window_size': 7,
+          'backfill_shard_days': 20, 'backfill_campaigns_per_unit': 2}
+
+
+class TestPlanBackfill(unittest.TestCase):
+    def plan(self, config, state=None):
+        with mock.patch('singer.utils.now', return_value=NOW):
+            return plan_backfill(config, state or {}, 'passphrase', ACCOUNT, [1, 2, 3])
+
+    def test_units_end_at_bucket_ends(self):
+        units = self.plan(CONFIG)
+        attribution_start = datetime(2026, 10, 15, tzinfo=timezone.utc)
+        for unit in units:
+            if unit.end != attribution_start:
+                self.assertEqual(get_bucket_end(unit.end - timedelta(days=1), 7), unit.end)
+        # the units of a campaign cover the days up to the attribution window without gaps
+        ends = [unit.end for unit in units if 1 in unit.campaign_ids]
+        starts = [unit.start for unit in units if 1 in unit.campaign_ids]
+        self.assertEqual(starts[0], datetime(2026, 8, 19, tzinfo=timezone.utc))
+        self.assertEqual(starts[1:], ends[:-1])
+        self.assertEqual(ends[-1], attribution_start)
+
+    def test_units_are_shard_days_long_with_daily_windows(self):
+        config = dict(CONFIG, report_backfill_window_size=1)
+        units = self.plan(config)
+        self.assertEqual(units[0].end - units[0].start, timedelta(days=20))
+
+    def test_campaigns_are_grouped_by_bookmark(self):
+        state = {'bookmarks': {'campaign_report': {'date(parent)': {ACCOUNT: {'3': '2026-10-01'}}}}}
+        units = self.plan(CONFIG, state)
+        self.assertEqual({tuple(unit.campaign_ids) for unit in units}, {(1, 2), (3,)})
+        self.assertEqual([(unit.start, unit.end) for unit in units if unit.campaign_ids == [3]],
+                         [(datetime(2026, 10, 1, tzinfo=timezone.utc), datetime(2026, 10, 15, tzinfo=timezone.utc))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from singer.utils import strftime
+
+from tap_tradetracker.streams import STREAMS
+from tap_tradetracker.sync import get_bucket_end, get_date_windows, get_report_dates, is_aggregated_window
+
+STREAM_NAME = 'campaign_report'
+ENDPOINT_CONFIG = STREAMS['campaigns']['children'][STREAM_NAME]
+NOW = datetime(2026, 10, 18, 12, 34, tzinfo=timezone.utc)
+CONFIG = {'attribution_window': 3, 'report_backfill_window_size': 7}
+
+
+def utc(year, month, day):
+    return datetime(year, month, day, tzinfo=timezone.utc)
+
+
+def plan(config, last_datetime, now=NOW, end_datetime=None):
+    with mock.patch('singer.utils.now', return_value=now):
+        return get_date_windows(config, STREAM_NAME, ENDPOINT_CONFIG, last_datetime, end_datetime)
+
+
+def get_rows(date_windows):
+    return [get_report_dates(start_window, end_window) for start_window, end_window in date_windows]
+
+
+def sync_windows(date_windows, bookmark):
+    """Moves the bookmark over the synced windows as sync_endpoint() does (a row per window)"""
+    for start_window, end_window in date_windows:
+        date_from, _ = get_report_dates(start_window, end_window)
+        bookmark = max(bookmark, datetime.combine(date_from, datetime.min.time(), timezone.utc))
+        if is_aggregated_window(STREAM_NAME, start_window, end_window):
+            bookmark = max(bookmark, end_window)
+    return bookmark
+
+
+class TestBucketEnd(unittest.TestCase):
+    def test_bucket_end(self):
+        bucket_end = get_bucket_end(utc(2026, 9, 7), 7)
+        self.assertEqual(bucket_end.toordinal() % 7, 0)
+        self.assertTrue(timedelta(days=1) <= bucket_end - utc(2026, 9, 7) <= timedelta(days=7))
+        # all days of a bucket have the same end, the end starts the next bucket
+        for day in range(7):
+            self.assertEqual(get_bucket_end(bucket_end - timedelta(days=7 - day, hours=-5), 7), bucket_end)
+        self.assertEqual(get_bucket_end(bucket_end, 7), bucket_end + timedelta(days=7))
+
+    def test_daily_bucket_end_is_next_midnight(self):
+        self.assertEqual(get_bucket_end(datetime(2026, 9, 7, 10, 11, tzinfo=timezone.utc), 1), utc(2026, 9, 8))
+
+
+class TestDateWindows(unittest.TestCase):
+    def test_backfill_windows_are_aligned_to_buckets(self):
+        rows = get_rows(plan(CONFIG, '2026-08-19T00:00:00Z'))
+        attribution_start = utc(2026, 10, 15).date()
+        aggregated = [(date_from, date_to) for date_from, date_to in rows if date_from < attribution_start]
+        self.assertEqual(aggregated[0][0], utc(2026, 8, 19).date())
+        for date_from, date_to in aggregated[1:-1]:
+            self.assertEqual(date_from.toordinal() % 7, 0)
+            self.assertEqual(date_to - date_from, timedelta(days=6))
+        self.assertEqual(aggregated[-1][1], attribution_start - timedelta(days=1))
+        # the attribution window is requested per day
+        self.assertEqual(rows[len(aggregated):], [(utc(2026, 10, day).date(),) * 2 for day in range(15, 19)])
+
+    def test_windows_are_daily_by_default(self):
+        rows = get_rows(plan({'attribution_window': 3}, '2026-10-10T00:00:00Z'))
+        self.assertEqual(rows, [(utc(2026, 10, day).date(),) * 2 for day in range(10, 19)])
+
+    def test_boundary_day_is_requested_once(self):
+        # the bookmark is at midnight of the first day of the attribution window (as after a backfill)
+        date_windows = plan(CONFIG, '2026-10-15T00:00:00Z')
+        self.assertEqual(date_windows[0], (utc(2026, 10, 15), utc(2026, 10, 16)))
+        rows = get_rows(date_windows)
+        self.assertEqual(rows, [(utc(2026, 10, day).date(),) * 2 for day in range(15, 19)])
+
+    def test_windows_end_at_end_datetime(self):
+        date_windows = plan(CONFIG, '2026-08-19T00:00:00Z', end_datetime=utc(2026, 9, 10))
+        self.assertEqual(date_windows[-1][1], utc(2026, 9, 10))
+        self.assertTrue(all(end_window <= utc(2026, 9, 10) for _, end_window in date_windows))
+
+    def test_interrupted_daily_runs_aggregate_the_same_days(self):
+        """Daily runs, some interrupted, never emit overlapping aggregated rows"""
+        bookmark = utc(2026, 7, 1)
+        rows = set()
+        for run in range(10):
+            now = NOW + timedelta(days=run)
+            date_windows = plan(CONFIG, strftime(bookmark), now=now)
+            if run in (0, 4):
+                # interrupted after some windows
+                date_windows = date_windows[:run + 3]
+            rows.update(get_rows(date_windows))
+            bookmark = sync_windows(date_windows, bookmark)
+
+        # each day is in exactly one row
+        days = {}
+        for date_from, date_to in rows:
+            day = date_from
+            while day <= date_to:
+                self.assertNotIn(day, days, f'{day} is in {days.get(day)} and {(date_from, date_to)}')
+                days[day] = (date_from, date_to)
+                day += timedelta(days=1)
+        last_day = (NOW + timedelta(days=9)).date()
+        self.assertEqual(len(days), (last_day - utc(2026, 7, 1).date()).days + 1)
+        # aggregated rows (but the first and the ones ending at an attribution window) are whole buckets
+        for date_from, date_to in rows:
+            if date_to > date_from and date_from > utc(2026, 7, 1).date():
+                self.assertEqual(date_from.toordinal() % 7, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
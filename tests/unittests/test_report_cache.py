@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from tap_tradetracker.cache import ReportCache
+
+ACCOUNT = '60d390029edfc3f7'
+DAY = date(2026, 10, 10)
+REPORT = {'overall_click_count': 7}
+
+
+class TestReportCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ReportCache(os.path.join(self.directory.name, 'reports.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_report_is_changed_until_committed(self):
+        self.assertTrue(self.cache.put(ACCOUNT, 1, DAY, DAY, REPORT))
+        self.assertIsNone(self.cache.get(ACCOUNT, 1, DAY, DAY))
+        # the sync of the first put failed: the report is still new
+        self.assertTrue(self.cache.put(ACCOUNT, 1, DAY, DAY, REPORT))
+
+        self.cache.commit()
+        self.assertEqual(self.cache.get(ACCOUNT, 1, DAY, DAY), REPORT)
+        self.assertFalse(self.cache.put(ACCOUNT, 1, DAY, DAY, REPORT))
+        self.assertTrue(self.cache.put(ACCOUNT, 1, DAY, DAY, {'overall_click_count': 8}))
+
+    def test_discarded_reports_are_not_committed(self):
+        self.cache.put(ACCOUNT, 1, DAY, DAY, REPORT)
+        self.cache.discard_pending()
+        self.cache.commit()
+        self.assertIsNone(self.cache.get(ACCOUNT, 1, DAY, DAY))
+        self.assertTrue(self.cache.put(ACCOUNT, 1, DAY, DAY, REPORT))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import io
+import json
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from singer.messages import StateMessage
+
+from tap_tradetracker import output
+from tap_tradetracker.client import get_account_label
+from tap_tradetracker.sync import (FORMER_ACCOUNTS, clear_former_accounts, get_bookmark, get_compact_bookmark,
+                                   get_last_activity, migrate_former_accounts, prune_activity, prune_bookmarks,
+                                   prune_state, set_last_activity, write_bookmark)
+
+ACCOUNT = '60d390029edfc3f7'
+OTHER_ACCOUNT = 'adfba10e74dfa360'
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)
+
+
+class StateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output = io.StringIO()
+        output.WRITER.output = self.output
+        output.WRITER.buffer_size = 0
+        output.WRITER.flush_interval = 0
+
+    def tearDown(self):
+        output.WRITER.output = None
+
+    def get_written_states(self):
+        return [json.loads(line)['value'] for line in self.output.getvalue().splitlines()
+                if json.loads(line)['type'] == 'STATE']
+
+
+class TestBookmarkMigration(StateTestCase):
+    def test_compact_bookmark(self):
+        self.assertEqual(get_compact_bookmark('2026-10-18T00:00:00.000000Z'), '2026-10-18')
+        self.assertEqual(get_compact_bookmark('2026-10-18T10:11:12.000000Z'), '2026-10-18T10:11:12Z')
+        self.assertEqual(get_compact_bookmark('2026-10-18T10:11:12.5Z'), '2026-10-18T10:11:12.500000Z')
+
+    def test_former_bookmark_is_read(self):
+        state = {'bookmarks': {'campaign_report': {'date(parent:1234)': '2026-10-01T00:00:00.000000Z'}}}
+        self.assertEqual(get_bookmark(state, 'campaign_report', '2020-01-01', 'date', 1234, ACCOUNT),
+                         '2026-10-01T00:00:00.000000Z')
+        self.assertEqual(get_bookmark(state, 'campaign_report', '2020-01-01', 'date', 1235, ACCOUNT),
+                         '2020-01-01')
+
+    def test_former_bookmark_is_replaced_when_written(self):
+        state = {'bookmarks': {'campaign_report': {'date(parent:1234)': '2026-10-01T00:00:00.000000Z',
+                                                   'date(parent:1235)': '2026-10-02T00:00:00.000000Z'}}}
+        write_bookmark(state, 'campaign_report', '2026-10-17T00:00:00.000000Z', 'date', 1234, ACCOUNT)
+
+        self.assertEqual(state['bookmarks']['campaign_report'], {
+            'date(parent)': {ACCOUNT: {'1234': '2026-10-17'}},
+            'date(parent:1235)': '2026-10-02T00:00:00.000000Z'})
+        self.assertEqual(get_bookmark(state, 'campaign_report', None, 'date', 1234, ACCOUNT), '2026-10-17')
+        # the indexed bookmark of one account does not apply to another account
+        self.assertIsNone(get_bookmark(state, 'campaign_report', None, 'date', 1234, OTHER_ACCOUNT))
+        self.assertEqual(self.get_written_states(), [state])
+
+    def test_bookmark_without_parent(self):
+        state = {}
+        write_bookmark(state, 'campaigns', '2026-10-17T00:00:00.000000Z', 'date')
+        self.assertEqual(state, {'bookmarks': {'campaigns': {'date': '2026-10-17T00:00:00.000000Z'}}})
+
+
+class TestPruning(StateTestCase):
+    def get_state(self):
+        return {
+            'bookmarks': {'campaign_report': {
+                'date(parent)': {ACCOUNT: {'1': '2024-03-01', '2': '2024-03-01', '3': '2026-10-17'},
+                                 OTHER_ACCOUNT: {'1': '2024-03-01'}},
+                'date(parent:4)': '2024-03-01T00:00:00.000000Z',
+                'date(parent:5)': '2024-03-01T00:00:00.000000Z'}},
+            'activity': {ACCOUNT: {'1': '2024-03-01', '2': '2024-03-01', '3': '2026-10-17'}},
+        }
+
+    def test_prune_bookmarks_of_removed_parents(self):
+        state = self.get_state()
+        # campaign 2 was removed (not returned anymore), campaign 1 is still backfilled
+        pruned = prune_bookmarks(state, {ACCOUNT: {'1', '3', '5'}, OTHER_ACCOUNT: {'1'}},
+                                 datetime(2025, 10, 18, tzinfo=timezone.utc))
+
+        self.assertEqual(pruned, 2)
+        self.assertEqual(state['bookmarks']['campaign_report'], {
+            'date(parent)': {ACCOUNT: {'1': '2024-03-01', '3': '2026-10-17'},
+                             OTHER_ACCOUNT: {'1': '2024-03-01'}},
+            'date(parent:5)': '2024-03-01T00:00:00.000000Z'})
+
+    def test_recent_bookmarks_of_removed_parents_are_kept(self):
+        state = self.get_state()
+        pruned = prune_bookmarks(state, {ACCOUNT: set(), OTHER_ACCOUNT: set()},
+                                 datetime(2024, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(pruned, 0)
+        self.assertEqual(state, self.get_state())
+
+    def test_bookmarks_of_unsynced_accounts_are_kept(self):
+        state = self.get_state()
+        prune_bookmarks(state, {ACCOUNT: set()}, datetime(2025, 10, 18, tzinfo=timezone.utc))
+        self.assertEqual(state['bookmarks']['campaign_report']['date(parent)'],
+                         {ACCOUNT: {'3': '2026-10-17'}, OTHER_ACCOUNT: {'1': '2024-03-01'}})
+
+    def test_prune_activity_of_removed_parents(self):
+        state = self.get_state()
+        pruned = prune_activity(state, {ACCOUNT: {'1'}}, datetime(2025, 10, 18).date())
+        self.assertEqual(pruned, 1)
+        self.assertEqual(state['activity'], {ACCOUNT: {'1': '2024-03-01', '3': '2026-10-17'}})
+
+    def test_prune_state_is_off_by_default(self):
+        state = self.get_state()
+        with mock.patch('singer.utils.now', return_value=NOW):
+            prune_state({}, state, {ACCOUNT: set(), OTHER_ACCOUNT: set()})
+        self.assertEqual(state, self.get_state())
+        self.assertEqual(self.get_written_states(), [])
+
+    def test_prune_state_keeps_active_backfills(self):
+        # a campaign backfilled from an old start_date keeps its old bookmark
+        state = self.get_state()
+        with mock.patch('singer.utils.now', return_value=NOW):
+            prune_state({'bookmark_retention_days': 365}, state, {ACCOUNT: {'1', '2', '3'}, OTHER_ACCOUNT: {'1'}})
+        self.assertEqual(get_bookmark(state, 'campaign_report', '2023-01-01', 'date', 1, ACCOUNT), '2024-03-01')
+        self.assertEqual(get_bookmark(state, 'campaign_report', '2023-01-01', 'date', 2, ACCOUNT), '2024-03-01')
+
+    def test_prune_state_writes_the_pruned_state(self):
+        state = self.get_state()
+        with mock.patch('singer.utils.now', return_value=NOW):
+            prune_state({'bookmark_retention_days': 365}, state, {ACCOUNT: {'3'}, OTHER_ACCOUNT: set()})
+        self.assertEqual(state['bookmarks']['campaign_report'], {'date(parent)': {ACCOUNT: {'3': '2026-10-17'}}})
+        self.assertEqual(state['activity'], {ACCOUNT: {'3': '2026-10-17'}})
+        self.assertEqual(self.get_written_states(), [state])
+
+
+class TestFormerAccounts(StateTestCase):
+    """A passphrase change: the bookmarks of the former account are found by campaign"""
+    CONFIG = {'customer_id': 1, 'passphrase': ['new passphrase']}
+
+    def setUp(self):
+        super().setUp()
+        self.account = get_account_label(1, 'new passphrase')
+        self.state = {
+            'bookmarks': {'campaign_report': {'date(parent)': {
+                ACCOUNT: {'1': '2026-10-01', '2': '2026-09-01'},
+                OTHER_ACCOUNT: {'1': '2026-10-05'}}}},
+            'activity': {ACCOUNT: {'1': '2026-09-30'}},
+        }
+
+    def test_former_accounts_are_migrated(self):
+        self.assertEqual(migrate_former_accounts(self.CONFIG, self.state), 4)
+        self.assertEqual(self.state['bookmarks']['campaign_report']['date(parent)'],
+                         {FORMER_ACCOUNTS: {'1': '2026-10-05', '2': '2026-09-01'}})
+        self.assertEqual(get_bookmark(self.state, 'campaign_report', '2020-01-01', 'date', 2, self.account),
+                         '2026-09-01')
+        self.assertEqual(get_last_activity(self.state, self.account, 1), datetime(2026, 9, 30).date())
+        # configured accounts are kept
+        self.assertEqual(migrate_former_accounts(dict(self.CONFIG, passphrase='new passphrase'), self.state), 0)
+
+    def test_configured_accounts_are_kept(self):
+        config = {'customer_id': 1, 'passphrase': 'a'}
+        self.state['bookmarks']['campaign_report']['date(parent)'][get_account_label(1, 'a')] = {'3': '2026-10-01'}
+        migrate_former_accounts(config, self.state)
+        self.assertEqual(get_bookmark(self.state, 'campaign_report', None, 'date', 3, get_account_label(1, 'a')),
+                         '2026-10-01')
+
+    def test_former_accounts_are_cleared_after_a_sync(self):
+        migrate_former_accounts(self.CONFIG, self.state)
+        write_bookmark(self.state, 'campaign_report', '2026-10-17T00:00:00.000000Z', 'date', 1, self.account)
+        set_last_activity(self.state, self.account, 1, datetime(2026, 9, 1).date())
+        # another account of the same campaign still finds the former bookmark during the sync
+        self.assertEqual(get_bookmark(self.state, 'campaign_report', None, 'date', 1, OTHER_ACCOUNT), '2026-10-05')
+        self.assertEqual(self.state['activity'][self.account], {'1': '2026-09-30'})
+
+        self.assertEqual(clear_former_accounts(self.state), 2)
+        self.assertEqual(self.state['bookmarks']['campaign_report']['date(parent)'],
+                         {self.account: {'1': '2026-10-17'}, FORMER_ACCOUNTS: {'2': '2026-09-01'}})
+        self.assertEqual(self.state['activity'], {self.account: {'1': '2026-09-30'}})
+        self.assertEqual(self.get_written_states()[-1], self.state)
+
+    def test_former_accounts_are_pruned_if_no_account_returns_the_parent(self):
+        migrate_former_accounts(self.CONFIG, self.state)
+        pruned = prune_bookmarks(self.state, {self.account: {'1'}}, datetime(2026, 10, 18, tzinfo=timezone.utc))
+        self.assertEqual(pruned, 1)
+        self.assertEqual(self.state['bookmarks']['campaign_report']['date(parent)'],
+                         {FORMER_ACCOUNTS: {'1': '2026-10-05'}})
+        self.assertEqual(prune_activity(self.state, {self.account: set()}, datetime(2026, 10, 18).date()), 1)
+        self.assertEqual(self.state['activity'], {})
+
+
+class TestStateSerialization(unittest.TestCase):
+    def test_state_is_compact_and_sorted(self):
+        writer = output.MessageWriter()
+        line = writer.format_message(StateMessage(value={'progress': {}, 'bookmarks': {'b': {'2': 'x', '1': 'y'}}}))
+        self.assertEqual(line, '{"type":"STATE","value":{"bookmarks":{"b":{"1":"y","2":"x"}},"progress":{}}}')
+
+    def test_latest_state_is_serialized_once(self):
+        file = io.StringIO()
+        writer = output.MessageWriter(output=file, buffer_size=65536, flush_interval=60)
+        state = {'bookmarks': {}}
+        with mock.patch.object(writer, 'format_state', wraps=writer.format_state) as format_state:
+            for day in range(1, 11):
+                state['bookmarks']['campaign_report'] = '2026-10-{:02d}'.format(day)
+                writer.write_message(StateMessage(value=state))
+            writer.flush()
+        self.assertEqual(format_state.call_count, 1)
+        self.assertEqual(file.getvalue(), '{"type":"STATE","value":{"bookmarks":{"campaign_report":"2026-10-10"}}}\n')
+
+
+if __name__ == '__main__':
+    unittest.main()